@@ -19,9 +19,9 @@ admin.site.register(Album, AlbumAdmin)
 
 class ImageAdmin(admin.ModelAdmin):
     fieldsets = ((None, {'fields': ['user', 'title', 'image', 'description', 'order', 'tags', 'album']}),)
-    list_display = ('admin_thumbnail', 'user', 'order', 'album', 'title')
+    list_display = ('admin_thumbnail', 'user', 'order', 'album', 'title', 'status', 'width', 'height', 'file_size')
     raw_id_fields = ('user', )
-    list_filter = ('album', )
+    list_filter = ('album', 'status')
 
 class AlbumUploadAdmin(admin.ModelAdmin):
     def has_change_permission(self, request, obj=None):
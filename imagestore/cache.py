@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.auth.models import Group
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from mezzanine.blog.models import BlogPost
+
+try:
+    from django.contrib.auth import get_user_model
+    User = get_user_model()
+except ImportError:
+    from django.contrib.auth.models import User
+
+PERMS_CACHE_TIMEOUT = getattr(settings, 'IMAGESTORE_PERMS_CACHE_TIMEOUT', 0)
+ALBUM_CACHE_TIMEOUT = getattr(settings, 'IMAGESTORE_ALBUM_CACHE_TIMEOUT', 0)
+# Keeps the cached id list well within the 1MB item limit of memcached
+ALBUM_CACHE_MAX_IMAGES = getattr(settings, 'IMAGESTORE_ALBUM_CACHE_MAX_IMAGES', 10000)
+BLOG_CACHE_TIMEOUT = getattr(settings, 'IMAGESTORE_BLOG_CACHE_TIMEOUT', 0)
+
+# Version keys must outlive the entries they guard, 30 days is the memcached maximum
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def _new_version():
+    # Start from the clock, so a version key evicted from the cache
+    # does not come back with a value used before
+    return int(time.time() * 1000)
+
+
+def get_versions(*keys):
+    """
+    Returns current values of version counters ``keys`` with a single cache read
+    """
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            versions[key] = _new_version()
+            cache.add(key, versions[key], VERSION_TIMEOUT)
+    return [versions[key] for key in keys]
+
+
+def bump_version(key):
+    """
+    Invalidates all entries cached under version counter ``key``
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), VERSION_TIMEOUT)
+
+
+def perms_version_key(user_id=None):
+    if user_id is None:
+        return 'imagestore:perms'
+    return 'imagestore:perms:%s' % user_id
+
+
+def get_perms(user, perms):
+    """
+    Returns dict of ``perms`` codenames mapped to ``user.has_perm(codename)``. The result
+    is cached for IMAGESTORE_PERMS_CACHE_TIMEOUT seconds until permissions of the user,
+    their groups or the groups' permissions change.
+    """
+    if not PERMS_CACHE_TIMEOUT or not user.is_authenticated():
+        return dict((name, user.has_perm(codename)) for name, codename in perms.items())
+    global_version, user_version = get_versions(perms_version_key(), perms_version_key(user.pk))
+    key = 'imagestore:perms:%s:%s:%s' % (user.pk, global_version, user_version)
+    result = cache.get(key)
+    if result is None:
+        result = dict((name, user.has_perm(codename)) for name, codename in perms.items())
+        cache.set(key, result, PERMS_CACHE_TIMEOUT)
+    return result
+
+
+def album_version_key(album_id):
+    return 'imagestore:album:%s' % album_id
+
+
+def get_album_version(album_id):
+    return get_versions(album_version_key(album_id))[0]
+
+
+def invalidate_album(album_id):
+    """
+    Has to be called after images of the album are changed bypassing save(),
+    e.g. with update() or bulk_create()
+    """
+    if album_id is not None:
+        bump_version(album_version_key(album_id))
+
+
+def get_album_listing(album_id):
+    """
+    Returns ids of images of the album in display order, or None for albums with
+    more than IMAGESTORE_ALBUM_CACHE_MAX_IMAGES images, which are listed with SQL.
+    Cached entry is read together with the album version in a single cache request.
+    """
+    from imagestore.models import Image
+    version_key = album_version_key(album_id)
+    listing_key = 'imagestore:album_listing:%s' % album_id
+    cached = cache.get_many([version_key, listing_key])
+    listing = cached.get(listing_key)
+    if version_key in cached and listing and listing['version'] == cached[version_key]:
+        return listing['ids']
+    version = get_album_version(album_id)
+    ids = list(Image.objects.filter(album=album_id).values_list('id', flat=True)[:ALBUM_CACHE_MAX_IMAGES + 1])
+    if len(ids) > ALBUM_CACHE_MAX_IMAGES:
+        # Remember that the album is too big, so it is not counted on every request
+        ids = None
+    cache.set(listing_key, {'version': version, 'ids': ids}, ALBUM_CACHE_TIMEOUT)
+    return ids
+
+
+def blog_post_key(user_id):
+    return 'imagestore:blog_post:%s' % user_id
+
+
+def get_blog_post(user):
+    """
+    Returns the first published blog post of ``user``, the vendor page shown
+    with their albums, or None. The post is cached for IMAGESTORE_BLOG_CACHE_TIMEOUT
+    seconds until a blog post of the user is saved or deleted.
+    """
+    key = blog_post_key(user.pk)
+    if BLOG_CACHE_TIMEOUT:
+        cached = cache.get(key)
+        if cached is not None:
+            # The absence of the post is cached as an empty tuple
+            return cached or None
+    blog_posts = BlogPost.objects.published(for_user=user).filter(user=user)[:1]
+    blog_post = blog_posts[0] if blog_posts else None
+    if BLOG_CACHE_TIMEOUT:
+        cache.set(key, blog_post or (), BLOG_CACHE_TIMEOUT)
+    return blog_post
+
+
+#noinspection PyUnusedLocal
+def invalidate_blog_post(instance, **kwargs):
+    cache.delete(blog_post_key(instance.user_id))
+
+
+#noinspection PyUnusedLocal
+def remember_album(instance, **kwargs):
+    # Image moved to another album invalidates both of them
+    instance._cached_album_id = instance.album_id
+
+
+#noinspection PyUnusedLocal
+def invalidate_image_album(instance, **kwargs):
+    invalidate_album(instance.album_id)
+    original = getattr(instance, '_cached_album_id', None)
+    if original != instance.album_id:
+        invalidate_album(original)
+    instance._cached_album_id = instance.album_id
+
+
+#noinspection PyUnusedLocal
+def invalidate_album_instance(instance, **kwargs):
+    invalidate_album(instance.pk)
+
+
+#noinspection PyUnusedLocal
+def invalidate_user_perms(instance, **kwargs):
+    bump_version(perms_version_key(instance.pk))
+
+
+#noinspection PyUnusedLocal
+def invalidate_user_m2m_perms(instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Permission or group changed its users
+        for pk in pk_set or ():
+            bump_version(perms_version_key(pk))
+        if action == 'post_clear':
+            bump_version(perms_version_key())
+    else:
+        bump_version(perms_version_key(instance.pk))
+
+
+#noinspection PyUnusedLocal
+def invalidate_group_perms(action, **kwargs):
+    if action.startswith('post_'):
+        bump_version(perms_version_key())
+
+
+if PERMS_CACHE_TIMEOUT:
+    # is_superuser and is_active are checked by has_perm too
+    post_save.connect(invalidate_user_perms, User)
+    m2m_changed.connect(invalidate_user_m2m_perms, User.user_permissions.through)
+    m2m_changed.connect(invalidate_user_m2m_perms, User.groups.through)
+    m2m_changed.connect(invalidate_group_perms, Group.permissions.through)
+
+if BLOG_CACHE_TIMEOUT:
+    post_save.connect(invalidate_blog_post, BlogPost)
+    post_delete.connect(invalidate_blog_post, BlogPost)
+
+
+def connect_album_signals():
+    from imagestore.models import Album, Image
+    post_init.connect(remember_album, Image)
+    post_save.connect(invalidate_image_album, Image)
+    post_delete.connect(invalidate_image_album, Image)
+    post_save.connect(invalidate_album_instance, Album)
+    post_delete.connect(invalidate_album_instance, Album)
@@ -5,25 +5,55 @@ from django.conf import settings
 from utils import get_model_string
 from imagestore.models import image_applabel, image_classname
 from imagestore.models import album_applabel, album_classname
+from imagestore.cache import get_perms
+
+IMAGESTORE_PERMS = {
+    'add_image': '%s.add_%s' % (image_applabel, image_classname),
+    'add_album': '%s.add_%s' % (album_applabel, album_classname),
+}
+
+_static_context = None
+
+
+def get_static_context():
+    """
+    Settings based part of the context, computed on the first request
+    """
+    global _static_context
+    if _static_context is None:
+        template = getattr(settings, 'IMAGESTORE_TEMPLATE', False)
+        ret = {
+            'IMAGESTORE_SHOW_USER': getattr(settings, 'IMAGESTORE_SHOW_USER', True),
+            'IMAGESTORE_SHOW_TAGS': getattr(settings, 'IMAGESTORE_SHOW_TAGS', True),
+            'IMAGESTORE_MODEL_STRING': get_model_string('Image'),
+            'IMAGESTORE_LOAD_CSS': getattr(settings, 'IMAGESTORE_LOAD_CSS', True),
+            }
+        if template:
+            ret['IMAGESTORE_TEMPLATE'] = template
+        try:
+            ret['imagestore_index_url'] = reverse('imagestore:index')
+        except NoReverseMatch: #Bastard django-cms from hell!!!!111
+            # urls may be not loaded yet, try again on the next request
+            return ret
+        _static_context = ret
+    return _static_context
+
+
+class LazyPermissions(object):
+    """
+    Checks imagestore permissions of the user only when a template uses them
+    """
+    def __init__(self, user):
+        self.user = user
+        self._perms = None
+
+    def __getitem__(self, name):
+        if self._perms is None:
+            self._perms = get_perms(self.user, IMAGESTORE_PERMS)
+        return self._perms[name]
+
 
 def imagestore_processor(request):
-    template = getattr(settings, 'IMAGESTORE_TEMPLATE', False)
-    ret = {
-        'IMAGESTORE_SHOW_USER': getattr(settings, 'IMAGESTORE_SHOW_USER', True),
-        'IMAGESTORE_SHOW_TAGS': getattr(settings, 'IMAGESTORE_SHOW_TAGS', True),
-        'IMAGESTORE_MODEL_STRING': get_model_string('Image'),
-        'IMAGESTORE_LOAD_CSS': getattr(settings, 'IMAGESTORE_LOAD_CSS', True),
-        }
-    try:
-        ret['imagestore_index_url'] = reverse('imagestore:index')
-    except NoReverseMatch: #Bastard django-cms from hell!!!!111
-        pass
-    if template:
-        ret['IMAGESTORE_TEMPLATE'] = template
-    ret['imagestore_perms'] = {
-        'add_image': request.user.has_perm('%s.add_%s' % (image_applabel, image_classname)),
-        'add_album': request.user.has_perm('%s.add_%s' % (album_applabel, album_classname)),
-    }
+    ret = get_static_context().copy()
+    ret['imagestore_perms'] = LazyPermissions(request.user)
     return ret
-
-  
\ No newline at end of file
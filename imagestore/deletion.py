@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import os
+import shutil
+import logging
+from django.conf import settings
+from django.db import transaction, router, models
+from django.db.models import Q
+from django.db.models.sql import DeleteQuery
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.contrib.contenttypes.models import ContentType
+from actstream.models import Action
+from sorl.thumbnail import delete
+
+from imagestore.models import Album, Image, FileTombstone
+from imagestore.processing import get_backend
+from imagestore.cache import invalidate_album
+
+logger = logging.getLogger(__name__)
+
+SWEEP_BATCH = getattr(settings, 'IMAGESTORE_SWEEP_BATCH', 100)
+
+
+def delete_actions(model, object_ids):
+    """
+    Deletes activity stream actions in which objects of ``model`` with
+    ``object_ids`` are the actor, the action object or the target
+    """
+    if not object_ids:
+        return
+    ctype = ContentType.objects.get_for_model(model)
+    # Object ids of actions are stored as text
+    object_ids = [unicode(object_id) for object_id in object_ids]
+    Action.objects.filter(
+        Q(actor_content_type=ctype, actor_object_id__in=object_ids)|
+        Q(action_object_content_type=ctype, action_object_object_id__in=object_ids)|
+        Q(target_content_type=ctype, target_object_id__in=object_ids)
+    ).delete()
+
+
+def delete_images(ids):
+    """
+    Deletes rows of images ``ids``, and the rows depending on them, with plain
+    DELETE and UPDATE statements. Unlike QuerySet.delete() the images are not
+    loaded and no signals are sent, the caller invalidates the album caches.
+    """
+    using = router.db_for_write(Image)
+    for i in range(0, len(ids), GET_ITERATOR_CHUNK_SIZE):
+        chunk = ids[i:i + GET_ITERATOR_CHUNK_SIZE]
+        for related in Image._meta.get_all_related_objects():
+            field = related.field
+            if field.rel.on_delete == models.SET_NULL:
+                related.model._base_manager.filter(**{'%s__in' % field.name: chunk}).update(**{field.name: None})
+            else:
+                DeleteQuery(related.model).delete_batch(chunk, using, field=field)
+        for field in Image._meta.many_to_many:
+            through = field.rel.through
+            DeleteQuery(through).delete_batch(chunk, using, field=through._meta.get_field(field.m2m_field_name()))
+        DeleteQuery(Image).delete_batch(chunk, using)
+
+
+def add_tombstones(names, directory=None):
+    """
+    Records stored files ``names``, and the ``directory`` tree, for removal by the sweep
+    """
+    tombstones = [FileTombstone(name=name) for name in names if name]
+    if directory:
+        tombstones.append(FileTombstone(name=directory, is_directory=True))
+    FileTombstone.objects.bulk_create(tombstones)
+
+
+def schedule_sweep():
+    """
+    Sweeps right away when the processing backend runs tasks in a background pool,
+    otherwise files wait for ``manage.py imagestore_sweep``
+    """
+    backend = get_backend()
+    if getattr(backend, 'runs_in_background', False):
+        backend.submit(sweep)
+
+
+@transaction.commit_on_success
+def soft_delete_image(image):
+    """
+    Hides the image at once. Its row and files are removed later by the sweep.
+    """
+    delete_actions(Image, [image.pk])
+    Image.all_objects.filter(pk=image.pk).update(is_deleted=True)
+    image.is_deleted = True
+    # Deleted image can not stay the head of the album
+    Album.objects.filter(head=image.pk).update(head=None)
+    invalidate_album(image.album_id)
+
+
+@transaction.commit_on_success
+def delete_album_images(album):
+    """
+    Deletes images of ``album`` and their activity with a few statements
+    and leaves their files, with the album directory, to the sweep.
+    """
+    images = Image.all_objects.filter(album=album)
+    ids, names = [], []
+    for image_id, name in images.values_list('id', 'image'):
+        ids.append(image_id)
+        names.append(name)
+    delete_actions(Image, ids)
+    add_tombstones(names, album.get_album_path())
+    delete_images(ids)
+    invalidate_album(album.pk)
+
+
+@transaction.commit_on_success
+def collect_deleted_images(batch=SWEEP_BATCH):
+    """
+    Deletes up to ``batch`` rows of soft deleted images, turning their files
+    into tombstones. Returns number of deleted rows.
+    """
+    images = list(Image.all_objects.filter(is_deleted=True).order_by('id').values_list('id', 'image')[:batch])
+    if not images:
+        return 0
+    ids = [image_id for image_id, name in images]
+    add_tombstones([name for image_id, name in images])
+    # Albums were invalidated when the images were hidden
+    delete_images(ids)
+    return len(ids)
+
+
+def remove_files(batch=SWEEP_BATCH, after=0):
+    """
+    Removes files of up to ``batch`` tombstones with ids greater than ``after``,
+    with their thumbnails, from the storage and deletes the tombstones. Tombstones
+    that failed are kept for the next sweep. Returns the last processed id or None.
+
+    Files are shared by images with the same content, so a file, or a directory,
+    still referred to by an image is kept.
+    """
+    tombstones = list(FileTombstone.objects.filter(pk__gt=after).order_by('id')[:batch])
+    if not tombstones:
+        return None
+    media_root = getattr(settings, 'MEDIA_ROOT', '/')
+    names = [tombstone.name for tombstone in tombstones if not tombstone.is_directory]
+    referenced = set(Image.all_objects.filter(image__in=names).values_list('image', flat=True))
+    removed = []
+    for tombstone in tombstones:
+        try:
+            if tombstone.is_directory:
+                prefix = tombstone.name.rstrip('/') + '/'
+                if not Image.all_objects.filter(image__startswith=prefix).exists():
+                    shutil.rmtree(os.path.join(media_root, tombstone.name), ignore_errors=True)
+            elif tombstone.name not in referenced:
+                delete(tombstone.name)
+        except Exception:
+            logger.exception('Failed to remove %s', tombstone.name)
+        else:
+            removed.append(tombstone.pk)
+    FileTombstone.objects.filter(pk__in=removed).delete()
+    return tombstones[-1].pk
+
+
+def sweep(batch=SWEEP_BATCH):
+    """
+    Removes all soft deleted images and tombstoned files in batches of ``batch``.
+    Tombstones are processed in id order, so album directories go after their files.
+    """
+    while collect_deleted_images(batch):
+        pass
+    last = 0
+    while last is not None:
+        last = remove_files(batch, last)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from datetime import datetime, timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from imagestore.models import ChunkedUpload
+
+
+class Command(BaseCommand):
+    help = 'Deletes chunked uploads, with their temporary files, that were not finished in time'
+    option_list = BaseCommand.option_list + (
+        make_option('--hours', type='int', dest='hours', default=24,
+                    help='Age of uploads to delete'),
+    )
+
+    def handle(self, *args, **options):
+        count = 0
+        for upload in ChunkedUpload.objects.filter(created__lt=datetime.now() - timedelta(hours=options['hours'])):
+            upload.delete()
+            count += 1
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Deleted %d uploads\n' % count)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import logging
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+try:
+    import Image as PILImage
+except ImportError:
+    from PIL import Image as PILImage
+
+from imagestore.models import Image
+from imagestore.processing import extract_metadata, make_placeholder, get_dhash, COLOR_SAMPLE_SIZE, METADATA_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Fields describing the stored file itself. Other fields, the EXIF date, come
+# from the upload and can not be read back: stored masters have no EXIF.
+STORED_FIELDS = ('width', 'height', 'file_size', 'format', 'placeholder', 'dominant_color', 'dhash')
+
+
+def read_metadata(task):
+    """
+    Reads metadata of a stored image in a worker thread. The pixels are decoded
+    at reduced scale for the placeholder and the hash only. Only empty fields are
+    filled, unless ``overwrite`` is set, which updates STORED_FIELDS as well.
+    """
+    image_id, name, current, overwrite = task
+    storage = Image._meta.get_field('image').storage
+    try:
+        f = storage.open(name)
+        try:
+            img = PILImage.open(f)
+            metadata = extract_metadata(img)
+            img.draft('RGB', (COLOR_SAMPLE_SIZE, COLOR_SAMPLE_SIZE))
+            img = img.convert('RGB')
+            metadata.update(make_placeholder(img))
+            metadata['dhash'] = get_dhash(img)
+        finally:
+            f.close()
+        metadata['file_size'] = storage.size(name)
+        values = dict((field, value) for field, value in metadata.items()
+                      if value not in (None, '') and
+                      (current[field] in (None, '') or (overwrite and field in STORED_FIELDS)))
+        if values:
+            Image.all_objects.filter(pk=image_id).update(**values)
+        return True
+    except Exception:
+        logger.exception('Failed to read metadata of image %s', image_id)
+        return False
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Fills dimensions, file size, format, EXIF date, placeholder and perceptual hash of images uploaded before they were recorded'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Read metadata of every image and update the fields describing the stored file, not only the empty ones'),
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of threads reading the files'),
+        make_option('--batch', type='int', dest='batch', default=1000,
+                    help='Number of images fetched from the database at once'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        images = Image.all_objects.exclude(image='').order_by('id')
+        if not options['all']:
+            images = images.filter(Q(width__isnull=True)|Q(placeholder='')|Q(dhash__isnull=True))
+        pool = ThreadPool(options['workers'])
+        done = failed = 0
+        last = 0
+        try:
+            while True:
+                rows = list(images.filter(pk__gt=last).values('id', 'image', *METADATA_FIELDS)[:options['batch']])
+                if not rows:
+                    break
+                last = rows[-1]['id']
+                tasks = [(row['id'], row['image'], row, options['all']) for row in rows]
+                for ok in pool.imap_unordered(read_metadata, tasks):
+                    if ok:
+                        done += 1
+                    else:
+                        failed += 1
+                if verbosity > 1:
+                    self.stdout.write('Processed images up to %s\n' % last)
+        finally:
+            pool.close()
+            pool.join()
+        if verbosity:
+            self.stdout.write('Updated %d images, %d failed\n' % (done, failed))
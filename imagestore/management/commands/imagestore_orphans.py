@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import os
+import time
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from imagestore.models import Image, FileTombstone
+from imagestore.utils import UPLOAD_TO
+from imagestore import deletion
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of os.scandir, avoids a stat() per file on large trees
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def iter_files(path):
+    """
+    Yields (path, mtime) of the files in the ``path`` tree
+    """
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                yield filepath, os.path.getmtime(filepath)
+        return
+    stack = [path]
+    while stack:
+        try:
+            entries = list(scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat().st_mtime
+
+
+class Command(BaseCommand):
+    help = 'Finds files under IMAGESTORE_UPLOAD_TO that no image refers to, and images whose file is missing'
+    option_list = BaseCommand.option_list + (
+        make_option('--delete', action='store_true', dest='delete', default=False,
+                    help='Delete the orphaned files with their thumbnails'),
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of threads scanning the upload directory'),
+        make_option('--age', type='int', dest='age', default=24,
+                    help='Ignore files modified less than this number of hours ago, they may be uploads in progress'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        # Unicode paths make the file system return unicode names, like the ones in the database
+        media_root = os.path.abspath(unicode(settings.MEDIA_ROOT))
+        root = os.path.join(media_root, UPLOAD_TO)
+        prefix = UPLOAD_TO.rstrip('/') + '/'
+        self.media_root = media_root
+        self.threshold = time.time() - options['age'] * 3600
+
+        self.known = set(Image.all_objects.values_list('image', flat=True).iterator())
+        self.known.update(FileTombstone.objects.filter(is_directory=False).values_list('name', flat=True).iterator())
+        # Names are discarded from the set as the files are found
+        self.missing = set(name for name in Image.objects.values_list('image', flat=True).iterator()
+                           if name.startswith(prefix))
+
+        # Every top level directory (a user directory by default) is scanned by its own worker
+        try:
+            entries = [os.path.join(root, name) for name in os.listdir(root)]
+        except OSError:
+            entries = []
+        dirs = [path for path in entries if os.path.isdir(path)]
+        orphans = self.scan_files((path, os.path.getmtime(path)) for path in entries if not os.path.isdir(path))
+        pool = ThreadPool(options['workers'])
+        try:
+            for found in pool.imap_unordered(self.scan_dir, dirs):
+                orphans.extend(found)
+        finally:
+            pool.close()
+            pool.join()
+
+        if verbosity > 1:
+            for name in orphans:
+                self.stdout.write('Orphaned file %s\n' % name)
+            for name in sorted(self.missing):
+                self.stdout.write('Missing file %s\n' % name)
+        if options['delete'] and orphans:
+            deletion.add_tombstones(orphans)
+            deletion.sweep()
+        if verbosity:
+            self.stdout.write('%d orphaned files%s, %d images with missing files\n' % (
+                len(orphans), options['delete'] and ' deleted' or '', len(self.missing)))
+
+    def scan_dir(self, path):
+        return self.scan_files(iter_files(path))
+
+    def scan_files(self, files):
+        orphans = []
+        for path, mtime in files:
+            name = os.path.relpath(path, self.media_root).replace(os.sep, '/')
+            self.missing.discard(name)
+            if name not in self.known and mtime < self.threshold:
+                orphans.append(name)
+        return orphans
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from imagestore.models import Image
+from imagestore.processing import process_image, STATUS_PENDING, STATUS_FAILED
+
+
+class Command(BaseCommand):
+    help = 'Resizes pending images uploaded while a deferred IMAGESTORE_PROCESSING_BACKEND is used, including the ones a pool backend missed'
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Process the pending images and exit instead of waiting for new ones'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+                    help='Put images that previously failed back to the queue'),
+        make_option('--interval', type='float', dest='interval', default=2.0,
+                    help='Seconds to sleep when the queue is empty'),
+        make_option('--batch', type='int', dest='batch', default=100,
+                    help='Number of images fetched from the queue at once'),
+    )
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            Image.objects.filter(status=STATUS_FAILED).update(status=STATUS_PENDING)
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            ids = list(Image.objects.filter(status=STATUS_PENDING).order_by('id').values_list('id', flat=True)[:options['batch']])
+            for image_id in ids:
+                ok = process_image(image_id)
+                if verbosity > 1 and ok is not None:
+                    self.stdout.write('%s image %s\n' % (ok and 'Processed' or 'Failed', image_id))
+            if not ids:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
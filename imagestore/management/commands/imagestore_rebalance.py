@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from imagestore.models import Album
+from imagestore import ordering
+
+
+class Command(BaseCommand):
+    help = 'Renumbers images of albums that ran out of free order keys (or all albums with --all)'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Renumber every album, e.g. to spread orders of albums created before sparse ordering'),
+        make_option('--album', type='int', dest='album', default=None,
+                    help='Only check album with this id'),
+    )
+
+    def handle(self, *args, **options):
+        albums = Album.objects.order_by('id')
+        if options['album']:
+            albums = albums.filter(id=options['album'])
+        verbosity = int(options.get('verbosity', 1))
+        count = 0
+        for album_id in albums.values_list('id', flat=True):
+            if self.rebalance(album_id, options['all']):
+                count += 1
+                if verbosity > 1:
+                    self.stdout.write('Renumbered album %s\n' % album_id)
+        if verbosity:
+            self.stdout.write('Renumbered %d albums\n' % count)
+
+    @transaction.commit_on_success
+    def rebalance(self, album_id, force):
+        album = ordering.lock_album(album_id)
+        orders = list(album.images.order_by('order').values_list('order', flat=True))
+        if force or ordering.needs_rebalance(orders):
+            ordering.rebalance_album(album_id)
+            return True
+        return False
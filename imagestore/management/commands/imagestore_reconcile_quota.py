@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from imagestore import quota
+
+
+class Command(BaseCommand):
+    help = 'Recomputes num_images of vendor blog posts from the uploaded images'
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        updated = quota.reconcile_counters()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Updated %d blog posts\n' % updated)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import os
+import json
+import logging
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from sorl.thumbnail import delete
+from imagestore.models import Image
+from imagestore.utils import get_file_layout
+from imagestore.processing import generate_variants
+from imagestore.cache import invalidate_album
+
+logger = logging.getLogger(__name__)
+
+
+def move_file(storage, old_name, new_name):
+    """
+    Moves stored file to ``new_name`` and returns the name it got
+    """
+    try:
+        old_path, new_path = storage.path(old_name), storage.path(new_name)
+    except NotImplementedError:
+        # Remote storage, copy the file over
+        f = storage.open(old_name)
+        try:
+            new_name = storage.save(new_name, f)
+        finally:
+            f.close()
+        return new_name
+    if os.path.exists(new_path):
+        new_name = storage.get_available_name(new_name)
+        new_path = storage.path(new_name)
+    directory = os.path.dirname(new_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    os.rename(old_path, new_path)
+    return new_name
+
+
+class Command(BaseCommand):
+    help = 'Moves image files to the paths given by IMAGESTORE_FILE_LAYOUT'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=500,
+                    help='Number of images moved in a transaction'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report the files that would be moved'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        layout = get_file_layout()
+        storage = Image._meta.get_field('image').storage
+        moved = 0
+        last = 0
+        while True:
+            images = list(Image.all_objects.select_related('user', 'album').filter(pk__gt=last)
+                          .order_by('id')[:options['batch']])
+            if not images:
+                break
+            last = images[-1].pk
+            moved += self.relocate(images, layout, storage, options['dry_run'], verbosity)
+        if verbosity:
+            self.stdout.write('%s %d files\n' % (options['dry_run'] and 'Would move' or 'Moved', moved))
+
+    @transaction.commit_on_success
+    def relocate(self, images, layout, storage, dry_run, verbosity):
+        moved = 0
+        albums = set()
+        # Images with the same content share the file, it is placed by the first of them
+        names = set(image.image.name for image in images if image.image.name)
+        owners = dict(Image.all_objects.filter(image__in=names).values_list('image')
+                      .annotate(first=Min('id')).order_by())
+        for image in images:
+            old_name = image.image.name
+            if not old_name or owners.get(old_name) != image.pk:
+                continue
+            try:
+                new_name = layout(image, os.path.basename(old_name))
+            except AttributeError, e:
+                # The legacy layout needs the album and the user of the image
+                self.stderr.write('Skipped image %s: %s\n' % (image.pk, e))
+                continue
+            if new_name == old_name:
+                continue
+            if verbosity > 1:
+                self.stdout.write('%s -> %s\n' % (old_name, new_name))
+            if dry_run:
+                moved += 1
+                continue
+            try:
+                new_name = move_file(storage, old_name, new_name)
+            except (IOError, OSError), e:
+                self.stderr.write('Failed to move %s: %s\n' % (old_name, e))
+                continue
+            # Thumbnails are keyed by the name of the source, they are made again from the new one
+            delete(old_name, delete_file=False)
+            image.image = new_name
+            try:
+                variants = json.dumps(generate_variants(image))
+            except Exception:
+                logger.exception('Failed to generate variants of %s', new_name)
+                # Variants are made on demand by sorl
+                variants = ''
+            shared = Image.all_objects.filter(image=old_name)
+            albums.update(shared.values_list('album', flat=True))
+            shared.update(image=new_name, variants=variants)
+            moved += 1
+            if storage.exists(old_name):
+                # Copied to a remote storage
+                storage.delete(old_name)
+        for album_id in albums:
+            invalidate_album(album_id)
+        return moved
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from imagestore.deletion import sweep, SWEEP_BATCH
+
+
+class Command(BaseCommand):
+    help = 'Removes rows and files of deleted images and albums from the database and the storage'
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Sweep the deleted files and exit instead of waiting for new ones'),
+        make_option('--interval', type='float', dest='interval', default=60.0,
+                    help='Seconds to sleep between sweeps'),
+        make_option('--batch', type='int', dest='batch', default=SWEEP_BATCH,
+                    help='Number of images or files removed at once'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            sweep(options['batch'])
+            if verbosity > 1:
+                self.stdout.write('Swept deleted files\n')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from imagestore.models import Image, ImageTag
+from imagestore.tagindex import parse_tags
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the tag index of images from their tags'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=1000,
+                    help='Number of images indexed in a transaction'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        last = 0
+        count = 0
+        while True:
+            images = list(Image.all_objects.filter(pk__gt=last).order_by('id').values_list('id', 'tags')[:options['batch']])
+            if not images:
+                break
+            last = images[-1][0]
+            count += self.index(images)
+        if verbosity:
+            self.stdout.write('Indexed %d image tags\n' % count)
+
+    @transaction.commit_on_success
+    def index(self, images):
+        ImageTag.objects.filter(image__in=[image_id for image_id, tags in images]).delete()
+        rows = [ImageTag(image_id=image_id, tag=name) for image_id, tags in images for name in parse_tags(tags)]
+        ImageTag.objects.bulk_create(rows)
+        return len(rows)
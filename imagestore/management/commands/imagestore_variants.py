@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from imagestore.models import Image
+from imagestore.processing import generate_variants, STATUS_READY
+from imagestore.cache import invalidate_album
+
+
+class Command(BaseCommand):
+    help = 'Generates IMAGESTORE_VARIANTS thumbnails for existing images'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Regenerate variants of every image, e.g. after IMAGESTORE_VARIANTS was changed'),
+    )
+
+    def handle(self, *args, **options):
+        images = Image.objects.filter(status=STATUS_READY).order_by('id')
+        if not options['all']:
+            images = images.filter(variants='')
+        verbosity = int(options.get('verbosity', 1))
+        count = 0
+        albums = set()
+        for image in images.iterator():
+            try:
+                image.set_variants(generate_variants(image))
+            except IOError, ex:
+                self.stderr.write('Image %s: %s\n' % (image.id, ex))
+                continue
+            Image.objects.filter(pk=image.pk).update(variants=image.variants)
+            albums.add(image.album_id)
+            count += 1
+            if verbosity > 1:
+                self.stdout.write('Image %s\n' % image.id)
+        for album_id in albums:
+            invalidate_album(album_id)
+        if verbosity:
+            self.stdout.write('Generated variants for %d images\n' % count)
@@ -16,4 +16,12 @@ album_applabel = Album._meta.app_label
 album_classname = Album.__name__.lower()
 
 
-from upload import AlbumUpload
\ No newline at end of file
+from upload import AlbumUpload, ChunkedUpload
+from tombstone import FileTombstone
+from tag import ImageTag
+
+# Connect cache invalidation and tag index handlers
+from imagestore.cache import connect_album_signals
+connect_album_signals()
+from imagestore.tagindex import connect_tag_signals
+connect_tag_signals()
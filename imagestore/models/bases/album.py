@@ -48,15 +48,21 @@ class BaseAlbum(models.Model):
     comments = CommentsField(verbose_name=_("Comments"))
 
     def get_head(self):
-        if self.head:
-            return self.head
-        else:
-            if self.images.all().count()>0:
-                self.head = self.images.all()[0]
-                self.save()
-                return self.head
+        """
+        Returns the head image or the first image of the album when no head is set.
+        The result is memoised on the instance, list views can prefill it
+        with ``set_head_cache`` to resolve heads for a whole page at once.
+        """
+        if not hasattr(self, '_resolved_head'):
+            if self.head_id:
+                self._resolved_head = self.head
             else:
-                return None
+                images = list(self.images.all()[:1])
+                self._resolved_head = images and images[0] or None
+        return self._resolved_head
+
+    def set_head_cache(self, image):
+        self._resolved_head = image
 
     @permalink
     def get_absolute_url(self):
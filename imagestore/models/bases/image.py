@@ -3,19 +3,18 @@
 
 __author__ = 'zeus'
 
-
+import json
 from django.db import models
 from django.db.models import permalink
 from sorl.thumbnail.helpers import ThumbnailError
 from tagging.fields import TagField
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-from sorl.thumbnail import ImageField, get_thumbnail, delete
+from sorl.thumbnail import ImageField, get_thumbnail
 from django.contrib.auth.models import Permission
 from django.db.models.signals import post_save
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.files.base import ContentFile
 
 try:
     from django.contrib.auth import get_user_model
@@ -29,10 +28,31 @@ except ImportError:
     from PIL import Image as PILImage
 
 from imagestore.utils import get_file_path, get_model_string
+from imagestore.processing import get_backend, normalise_image, process_image, generate_variants, parse_variant
+from imagestore.processing import hash_file, find_duplicate, copy_metadata
+from imagestore.processing import VARIANTS
+from imagestore.processing import STATUS_PENDING, STATUS_PROCESSING, STATUS_READY, STATUS_FAILED
 from mezzanine.generic.fields import CommentsField
 
 SELF_MANAGE = getattr(settings, 'IMAGESTORE_SELF_MANAGE', True)
 
+STATUS_CHOICES = (
+    (STATUS_PENDING, _('Pending')),
+    (STATUS_PROCESSING, _('Processing')),
+    (STATUS_READY, _('Ready')),
+    (STATUS_FAILED, _('Failed')),
+)
+
+
+class ImageManager(models.Manager):
+    """
+    Hides images deleted with soft_delete(), which are waiting for imagestore_sweep
+    """
+    use_for_related_fields = True
+
+    def get_query_set(self):
+        return super(ImageManager, self).get_query_set().filter(is_deleted=False)
+
 
 class BaseImage(models.Model):
     class Meta(object):
@@ -51,9 +71,24 @@ class BaseImage(models.Model):
     created = models.DateTimeField(_('Created'), auto_now_add=True, null=True)
     updated = models.DateTimeField(_('Updated'), auto_now=True, null=True)
     album = models.ForeignKey(get_model_string('Album'), verbose_name=_('Album'), null=True, blank=True, related_name='images')
+    status = models.CharField(_('Status'), max_length=10, choices=STATUS_CHOICES, default=STATUS_READY, editable=False, db_index=True)
+    variants = models.TextField(_('Variants'), blank=True, editable=False)
+    is_deleted = models.BooleanField(_('Deleted'), default=False, editable=False, db_index=True)
+    content_hash = models.CharField(_('Content hash'), max_length=40, blank=True, editable=False, db_index=True)
+    width = models.PositiveIntegerField(_('Width'), null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(_('Height'), null=True, blank=True, editable=False)
+    file_size = models.PositiveIntegerField(_('File size'), null=True, blank=True, editable=False, db_index=True)
+    format = models.CharField(_('Format'), max_length=10, blank=True, editable=False)
+    taken_at = models.DateTimeField(_('Taken at'), null=True, blank=True, editable=False, db_index=True)
+    placeholder = models.TextField(_('Placeholder'), blank=True, editable=False)
+    dominant_color = models.CharField(_('Dominant colour'), max_length=7, blank=True, editable=False)
+    dhash = models.BigIntegerField(_('Perceptual hash'), null=True, blank=True, editable=False, db_index=True)
 
     comments = CommentsField(verbose_name=_("Comments"))
-    
+
+    objects = ImageManager()
+    all_objects = models.Manager()
+
     @permalink
     def get_absolute_url(self):
         return 'imagestore:render_album', (), {'album_id': self.album.id}
@@ -70,17 +105,68 @@ class BaseImage(models.Model):
         except ThumbnailError, ex:
             return 'ThumbnailError, %s' % ex.message
 
+    @property
+    def is_ready(self):
+        return self.status == STATUS_READY
+
+    def get_variants(self):
+        if not hasattr(self, '_variants_cache'):
+            self._variants_cache = self.variants and json.loads(self.variants) or {}
+        return self._variants_cache
+
+    def set_variants(self, variants):
+        self.variants = json.dumps(variants)
+        self._variants_cache = variants
+
+    def get_variant_url(self, name):
+        """
+        Returns url of the IMAGESTORE_VARIANTS thumbnail ``name``. Images that are not
+        processed yet, or were uploaded before the variant was added, fall back to sorl.
+        """
+        variant = self.get_variants().get(name)
+        if variant:
+            return variant['url']
+        geometry, options = parse_variant(VARIANTS[name])
+        return get_thumbnail(self.image, geometry, **options).url
+
+    def share_duplicate(self):
+        """
+        Hashes the uploaded file and, if the owner uploaded the same content before,
+        points the image to the stored file and variants of the earlier image.
+        Returns True if the duplicate was found.
+        """
+        self.content_hash = hash_file(self.image.file)
+        duplicate = find_duplicate(self.content_hash, self.user_id)
+        if duplicate is None:
+            return False
+        self.image = duplicate.image.name
+        self.set_variants(duplicate.get_variants())
+        copy_metadata(duplicate, self)
+        self.status = STATUS_READY
+        return True
+
     def save(self, *args, **kwargs):
-        if not self.id:
-            # Have to save the image (and imagefield) first
+        if self.image and not self.image._committed and self.share_duplicate():
+            # Stored file is shared, there is nothing to resize
             super(BaseImage, self).save(*args, **kwargs)
-            # obj is being created for the first time - resize
-            quality = getattr(settings, 'IMAGESTORE_IMAGE_QUALITY', 95)
-            resized = get_thumbnail(self.image, "1000x1000", quality=quality)
-            # Delete the original image and reassign the resized image to the image field
-            self.image.delete()
-            self.image.save(resized.name, ContentFile(resized.read()), True)
-            delete(resized)
+            return
+        if not self.id:
+            backend = get_backend()
+            if backend.deferred:
+                # Persist the upload as is and let the worker resize it
+                self.status = STATUS_PENDING
+                super(BaseImage, self).save(*args, **kwargs)
+                backend.submit(process_image, self.pk)
+                return
+            # obj is being created for the first time - resize, so only
+            # the resized file is written to the storage
+            normalise_image(self)
+            self.set_variants(generate_variants(self))
+        elif self.image and not self.image._committed:
+            # New file is uploaded for existing image, resize it like a new upload,
+            # so the metadata and the variants describe the new file
+            normalise_image(self)
+            self.set_variants(generate_variants(self))
         super(BaseImage, self).save(*args, **kwargs)
 
     admin_thumbnail.short_description = _('Thumbnail')
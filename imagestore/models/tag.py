@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from django.db import models
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+from imagestore.models import Image
+
+
+class ImageTag(models.Model):
+    """
+    Tag membership of images, kept in sync with Image.tags by imagestore.tagindex
+    """
+    tag = models.CharField(_('Tag'), max_length=getattr(settings, 'MAX_TAG_LENGTH', 50))
+    image = models.ForeignKey(Image, verbose_name=_('Image'), related_name='tag_index')
+
+    class Meta(object):
+        verbose_name = _('Image tag')
+        verbose_name_plural = _('Image tags')
+        app_label = 'imagestore'
+        unique_together = (('tag', 'image'),)
+
+    def __unicode__(self):
+        return self.tag
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class FileTombstone(models.Model):
+    """
+    Stored file, or directory tree, left by a deleted image or album.
+    Removed from the storage by ``manage.py imagestore_sweep``.
+    """
+    name = models.CharField(_('Name'), max_length=255)
+    is_directory = models.BooleanField(_('Directory'), default=False)
+    created = models.DateTimeField(_('Created'), auto_now_add=True)
+
+    class Meta(object):
+        verbose_name = _('File tombstone')
+        verbose_name_plural = _('File tombstones')
+        app_label = 'imagestore'
+
+    def __unicode__(self):
+        return self.name
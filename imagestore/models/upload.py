@@ -4,20 +4,39 @@
 __author__ = 'zeus'
 
 import os
+import uuid
+import logging
 import zipfile
-from django.db import models
+import tempfile
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from django.db import models, connection
 from imagestore.utils import load_class, get_model_string
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
-from django.core.files.base import ContentFile
+from sorl.thumbnail import delete
 try:
     import Image as PILImage
 except ImportError:
     from PIL import Image as PILImage
 
+try:
+    from django.contrib.auth import get_user_model
+    User = get_user_model()
+except ImportError:
+    from django.contrib.auth.models import User
+
 from imagestore.models import Album, Image
+from imagestore import ordering
+from imagestore.processing import decode_image_file, set_metadata, copy_metadata, generate_variants
+from imagestore.processing import hash_file, find_duplicate, STATUS_READY
+from imagestore.cache import invalidate_album
+
+logger = logging.getLogger(__name__)
 
 TEMP_DIR = getattr(settings, 'TEMP_DIR', 'temp/')
+UPLOAD_WORKERS = getattr(settings, 'IMAGESTORE_UPLOAD_WORKERS', 4)
+CHUNKED_UPLOAD_DIR = getattr(settings, 'IMAGESTORE_CHUNKED_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'imagestore'))
 
 class AlbumUpload(models.Model):
     """
@@ -50,38 +69,179 @@ class AlbumUpload(models.Model):
         super(AlbumUpload, self).delete()
         return album
 
-    def process_zipfile(self):
+    def process_zipfile(self, progress=None):
+        """
+        Imports images from the archive in a pool of IMAGESTORE_UPLOAD_WORKERS threads.
+        Each member is read and decoded once, the rows are inserted in bulk.
+        ``progress`` is called with the number of processed and all members.
+        """
         if os.path.isfile(self.zip_file.path):
-            # TODO: implement try-except here
             zip = zipfile.ZipFile(self.zip_file.path)
-            bad_file = zip.testzip()
-            if bad_file:
-                raise Exception('"%s" in the .zip archive is corrupt.' % bad_file)
-            count = 1
+            try:
+                # do not process meta files and directories
+                names = sorted(info.filename for info in zip.infolist()
+                               if not info.filename.startswith('__') and info.file_size)
+            finally:
+                zip.close()
             album = self.album
             if not album:
                 album = Album.objects.create(name=self.new_album_name)
-            from cStringIO import StringIO
-            for filename in sorted(zip.namelist()):
-                if filename.startswith('__'): # do not process meta files
-                    continue
-                data = zip.read(filename)
-                if len(data):
-                    try:
-                        # the following is taken from django.newforms.fields.ImageField:
-                        #  load() is the only method that can spot a truncated JPEG,
-                        #  but it cannot be called sanely after verify()
-                        trial_image = PILImage.open(StringIO(data))
-                        trial_image.load()
-                        # verify() is the only method that can spot a corrupt PNG,
-                        #  but it must be called immediately after the constructor
-                        trial_image = PILImage.open(StringIO(data))
-                        trial_image.verify()
-                    except Exception:
-                        # if a "bad" file is found we just skip it.
-                        continue
-                    img = Image(album=album)
-                    img.image.save(filename, ContentFile(data))
-                    img.save()
-            zip.close()
+            images = []
+            # Files stored by this import, removed if the rows can not be inserted
+            stored = []
+            pool = ThreadPool(max(min(UPLOAD_WORKERS, len(names)), 1))
+            try:
+                tasks = [(self.zip_file.path, filename, album) for filename in names]
+                for count, result in enumerate(pool.imap(import_member, tasks), 1):
+                    if result is not None:
+                        image, is_new = result
+                        images.append(image)
+                        if is_new:
+                            stored.append(image.image.name)
+                    if progress:
+                        progress(count, len(names))
+                    logger.debug('Imported %d of %d files from %s', count, len(names), self.zip_file.name)
+            finally:
+                pool.close()
+                pool.join()
+            order = ordering.next_order(album)
+            for image in images:
+                image.order = order
+                order += ordering.ORDER_STEP
+            try:
+                Image.objects.bulk_create(images)
+            except Exception:
+                for name in stored:
+                    delete(name)
+                raise
+            invalidate_album(album.pk)
             return album
+
+
+def import_member(task):
+    """
+    Reads, validates and resizes a single archive member in a worker thread.
+    Returns unsaved Image with the file and variants stored, and whether the file
+    was stored by this import rather than shared, or None for a bad file.
+    """
+    path, filename, album = task
+    zip = zipfile.ZipFile(path)
+    name = None
+    try:
+        # ZipExtFile checks the CRC once the member is read to the end
+        data = zip.open(filename).read()
+        content_hash = hash_file(StringIO(data))
+        duplicate = find_duplicate(content_hash, album.user_id)
+        if duplicate is not None:
+            # The same photo is stored already, share its file
+            img = Image(album=album, user=album.user, status=STATUS_READY, content_hash=content_hash,
+                        image=duplicate.image.name, variants=duplicate.variants)
+            copy_metadata(duplicate, img)
+            return img, False
+        try:
+            # decoding is the only validation, it spots truncated and corrupt files
+            content, metadata = decode_image_file(StringIO(data))
+        except Exception:
+            # if a "bad" file is found we just skip it.
+            return None
+        del data
+        img = Image(album=album, user=album.user, status=STATUS_READY, content_hash=content_hash)
+        set_metadata(img, metadata)
+        img.image.save('%s.jpg' % os.path.splitext(os.path.basename(filename))[0], content, save=False)
+        name = img.image.name
+        img.set_variants(generate_variants(img))
+        return img, True
+    except zipfile.BadZipfile:
+        logger.warning('"%s" in the .zip archive is corrupt.', filename)
+        return None
+    except Exception:
+        # One failed member must not abort the whole import
+        logger.exception('Failed to import "%s" from the .zip archive', filename)
+        if name:
+            delete(name)
+        return None
+    finally:
+        zip.close()
+        connection.close()
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def new_upload_id():
+    return uuid.uuid4().hex
+
+
+class ChunkedUpload(models.Model):
+    """
+    Upload of a single image sent in chunks, which are appended to a temporary file
+    in IMAGESTORE_CHUNKED_UPLOAD_DIR. ``offset`` is the number of bytes received so far.
+    """
+    upload_id = models.CharField(max_length=32, unique=True, default=new_upload_id, editable=False)
+    user = models.ForeignKey(User, related_name='chunked_uploads')
+    filename = models.CharField(max_length=255)
+    offset = models.BigIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta(object):
+        verbose_name = _('Chunked upload')
+        verbose_name_plural = _('Chunked uploads')
+        app_label = 'imagestore'
+
+    @property
+    def path(self):
+        return os.path.join(CHUNKED_UPLOAD_DIR, self.upload_id)
+
+    def save(self, *args, **kwargs):
+        if not self.id:
+            if not os.path.isdir(CHUNKED_UPLOAD_DIR):
+                os.makedirs(CHUNKED_UPLOAD_DIR)
+            open(self.path, 'wb').close()
+        super(ChunkedUpload, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(ChunkedUpload, self).delete(*args, **kwargs)
+
+    def append(self, stream, offset, max_size, chunk_size=64 * 1024):
+        """
+        Writes data read from ``stream`` at ``offset``. Returns the new offset or
+        None if another chunk was written at this offset meanwhile. Raises
+        UploadTooLarge, without reading the rest of the stream, once the upload
+        grows over ``max_size`` bytes.
+        """
+        left = max_size - offset
+        f = open(self.path, 'r+b')
+        try:
+            f.seek(offset)
+            while True:
+                # Read one byte over the limit to tell whether it was crossed
+                chunk = stream.read(min(chunk_size, left + 1))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                if left < 0:
+                    raise UploadTooLarge()
+                f.write(chunk)
+            end = f.tell()
+        finally:
+            f.close()
+        if not ChunkedUpload.objects.filter(pk=self.pk, offset=offset).update(offset=end):
+            return None
+        self.offset = end
+        return end
+
+    def is_image(self):
+        """
+        Checks the image header of the data received so far, without decoding it
+        """
+        f = open(self.path, 'rb')
+        try:
+            PILImage.open(f)
+        except Exception:
+            return False
+        finally:
+            f.close()
+        return True
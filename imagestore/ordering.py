@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from django.conf import settings
+from django.db import connection
+
+from imagestore.models import Album, Image
+from imagestore.cache import invalidate_album
+
+# Images are ordered by sparse keys spaced by ORDER_STEP, so an image is moved
+# between two others by changing its own key only. The album is renumbered
+# when there is no free key left between the neighbours. Keys start at ORDER_STEP,
+# so an image moved to the head of the album takes a key in [0, first key).
+ORDER_STEP = getattr(settings, 'IMAGESTORE_ORDER_STEP', 1024)
+
+
+def lock_album(album_id):
+    """
+    Locks the album row until the end of the transaction, so reorderings
+    of the same album are serialised.
+    """
+    return Album.objects.select_for_update().get(pk=album_id)
+
+
+def next_order(album):
+    """
+    Returns order key for an image appended to the end of the album
+    """
+    last = album.images.order_by('-order').values_list('order', flat=True)[:1]
+    if last:
+        return last[0] + ORDER_STEP
+    return ORDER_STEP
+
+
+def free_range(images, order, after):
+    """
+    Returns keys around the free range next to ``order``: after it or before it.
+    Keys are never negative, they are used in urls.
+    """
+    if after:
+        following = list(images.filter(order__gt=order).order_by('order').values_list('order', flat=True)[:1])
+        return order, following[0] if following else order + 2 * ORDER_STEP
+    preceding = list(images.filter(order__lt=order).order_by('-order').values_list('order', flat=True)[:1])
+    return preceding[0] if preceding else -1, order
+
+
+def move_image(image_id, new_order):
+    """
+    Moves image next to the image with order ``new_order``: after it when the
+    image is moved down, before it when moved up. Only the moved image is
+    updated unless the album has to be renumbered.
+    Must be called inside a transaction.
+    Returns (image id, order) pairs of the changed images.
+    """
+    album_id = Image.objects.filter(pk=image_id).values_list('album', flat=True)[0]
+    lock_album(album_id)
+    # Re-read the order under the lock, a concurrent move could have changed it
+    old_order = Image.objects.filter(pk=image_id).values_list('order', flat=True)[0]
+    if new_order == old_order:
+        return []
+    after = new_order > old_order
+    images = Image.objects.filter(album=album_id).exclude(pk=image_id)
+    low, high = free_range(images, new_order, after)
+    changed = []
+    if high - low < 2:
+        neighbour = list(images.filter(order=new_order).values_list('id', flat=True)[:1])
+        changed = rebalance_album(album_id)
+        if not neighbour:
+            return changed
+        new_order = dict(changed)[neighbour[0]]
+        low, high = free_range(images, new_order, after)
+    order = (low + high) // 2
+    Image.objects.filter(pk=image_id).update(order=order)
+    invalidate_album(album_id)
+    return [(pk, value) for pk, value in changed if pk != image_id] + [(image_id, order)]
+
+
+def set_orders(orders):
+    """
+    Writes ``orders``, a list of (image id, order) pairs, with a single UPDATE.
+    """
+    if not orders:
+        return
+    qn = connection.ops.quote_name
+    opts = Image._meta
+    pk = qn(opts.pk.column)
+    sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+        qn(opts.db_table),
+        qn(opts.get_field('order').column),
+        pk,
+        ' '.join(['WHEN %s THEN %s'] * len(orders)),
+        pk,
+        ', '.join(['%s'] * len(orders)),
+    )
+    params = []
+    for image_id, order in orders:
+        params.extend((image_id, order))
+    params.extend(image_id for image_id, order in orders)
+    connection.cursor().execute(sql, params)
+
+
+def needs_rebalance(orders):
+    """
+    Tells whether sorted ``orders`` have neighbours without a free key between them,
+    or a negative key
+    """
+    if orders and orders[0] < 0:
+        return True
+    return any(b - a < 2 for a, b in zip(orders, orders[1:]))
+
+
+def rebalance_album(album_id):
+    """
+    Renumbers images of the album with ORDER_STEP spacing, keeping their order.
+    Returns (image id, order) pairs.
+    """
+    ids = Image.objects.filter(album=album_id).order_by('order', 'id').values_list('id', flat=True)
+    orders = [(image_id, (i + 1) * ORDER_STEP) for i, image_id in enumerate(ids)]
+    set_orders(orders)
+    invalidate_album(album_id)
+    return orders
+
+
+def reorder_album(album, image_ids):
+    """
+    Orders images of the album as listed in ``image_ids``. Images that are not
+    listed keep their relative order after the listed ones.
+    Must be called inside a transaction.
+    """
+    lock_album(album.pk)
+    current = list(album.images.values_list('id', flat=True))
+    existing = set(current)
+    listed = set(image_ids)
+    ids = [image_id for image_id in image_ids if image_id in existing]
+    ids += [image_id for image_id in current if image_id not in listed]
+    set_orders([(image_id, (i + 1) * ORDER_STEP) for i, image_id in enumerate(ids)])
+    invalidate_album(album.pk)
+    return ids
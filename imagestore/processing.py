@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import os
+import time
+import base64
+import hashlib
+from datetime import datetime
+import logging
+import threading
+from cStringIO import StringIO
+from multiprocessing.pool import Pool, ThreadPool
+from django.conf import settings
+from django.db import connection
+from django.core.files.base import ContentFile
+from sorl.thumbnail import get_thumbnail, delete
+try:
+    import Image as PILImage
+    import ImageFile as PILImageFile
+except ImportError:
+    from PIL import Image as PILImage
+    from PIL import ImageFile as PILImageFile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from imagestore.utils import load_class
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_BACKEND = getattr(settings, 'IMAGESTORE_PROCESSING_BACKEND', 'imagestore.processing.SyncBackend')
+PROCESSING_WORKERS = getattr(settings, 'IMAGESTORE_PROCESSING_WORKERS', 2)
+
+RESIZE_SIZE = (1000, 1000)
+# Follow sorl, which used to do the resize, in whether small images are scaled up
+UPSCALE = getattr(settings, 'THUMBNAIL_UPSCALE', True)
+
+# Templates use the default variants, the setting adds to them or overrides their specs
+VARIANTS = {
+    'thumb': '120x120 crop',
+    'head': '100x100 crop',
+    'full': '600x600',
+    'preview': '800x800',
+}
+VARIANTS.update(getattr(settings, 'IMAGESTORE_VARIANTS', {}))
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+# Image fields filled from the upload by extract_metadata()
+METADATA_FIELDS = ('width', 'height', 'file_size', 'format', 'taken_at', 'placeholder', 'dominant_color', 'dhash')
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_DATETIME = 306
+EXIF_ORIENTATION = 274
+
+# Transpositions turning the image upright, by the EXIF orientation
+ORIENTATION_TRANSPOSE = {
+    2: (PILImage.FLIP_LEFT_RIGHT,),
+    3: (PILImage.ROTATE_180,),
+    4: (PILImage.FLIP_TOP_BOTTOM,),
+    5: (PILImage.ROTATE_270, PILImage.FLIP_LEFT_RIGHT),
+    6: (PILImage.ROTATE_270,),
+    7: (PILImage.ROTATE_90, PILImage.FLIP_LEFT_RIGHT),
+    8: (PILImage.ROTATE_90,),
+}
+
+# Optimised and progressive JPEGs are encoded in a single block, which
+# has to fit the largest image we write
+PILImageFile.MAXBLOCK = max(PILImageFile.MAXBLOCK, RESIZE_SIZE[0] * RESIZE_SIZE[1] * 3)
+
+# Longer side of the inline preview, the browser scales it up blurred
+PLACEHOLDER_SIZE = getattr(settings, 'IMAGESTORE_PLACEHOLDER_SIZE', 16)
+PLACEHOLDER_QUALITY = 40
+COLOR_SAMPLE_SIZE = 64
+
+STATUS_PENDING = 'pending'
+STATUS_PROCESSING = 'processing'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+
+def hash_file(f):
+    """
+    Returns hex SHA-1 digest of the content of file-like ``f``, read in chunks
+    """
+    digest = hashlib.sha1()
+    f.seek(0)
+    while True:
+        chunk = f.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+def find_duplicate(content_hash, user_id):
+    """
+    Returns a processed image of user ``user_id`` with the same uploaded content,
+    whose stored file and variants can be shared, or None. Files are not shared
+    between users, their paths may tell the album of the owner.
+    """
+    from imagestore.models import Image
+    if user_id is None:
+        return None
+    duplicates = Image.objects.filter(content_hash=content_hash, user=user_id, status=STATUS_READY).exclude(image='')[:1]
+    return duplicates[0] if duplicates else None
+
+
+def get_exif(img):
+    """
+    Returns EXIF tags of opened PIL image ``img`` as a dict
+    """
+    try:
+        return img._getexif() or {}
+    except Exception:
+        # No EXIF support for the format, or broken EXIF
+        return {}
+
+
+def get_taken_at(exif):
+    """
+    Returns the time the photo was taken from ``exif`` tags, or None
+    """
+    for tag in (EXIF_DATETIME_ORIGINAL, EXIF_DATETIME):
+        value = exif.get(tag)
+        if value:
+            try:
+                return datetime.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+            except (ValueError, TypeError):
+                pass
+    return None
+
+
+def extract_metadata(img, content=None, exif=None):
+    """
+    Returns values of METADATA_FIELDS for opened PIL image ``img``. Dimensions
+    and size are the ones of ``content``, the stored copy, when it is given.
+    """
+    if exif is None:
+        exif = get_exif(img)
+    return {
+        'width': img.size[0],
+        'height': img.size[1],
+        'file_size': content.size if content is not None else None,
+        'format': img.format or '',
+        'taken_at': get_taken_at(exif),
+    }
+
+
+def get_dominant_color(img):
+    """
+    Returns the dominant colour of small RGB PIL image ``img`` as '#rrggbb'.
+    Colours are bucketed by their 4 high bits per channel and the pixels of
+    the largest bucket are averaged.
+    """
+    if numpy is not None:
+        pixels = numpy.asarray(img, dtype=numpy.uint8).reshape(-1, 3)
+        buckets = pixels >> 4
+        keys = (buckets[:, 0].astype(numpy.int32) << 8) | (buckets[:, 1].astype(numpy.int32) << 4) | buckets[:, 2]
+        counts = numpy.bincount(keys, minlength=4096)
+        color = pixels[keys == counts.argmax()].mean(axis=0)
+    else:
+        buckets = {}
+        for count, (r, g, b) in img.getcolors(img.size[0] * img.size[1]):
+            bucket = buckets.setdefault((r >> 4, g >> 4, b >> 4), [0, 0, 0, 0])
+            bucket[0] += count
+            bucket[1] += r * count
+            bucket[2] += g * count
+            bucket[3] += b * count
+        total, r, g, b = max(buckets.values())
+        color = (float(r) / total, float(g) / total, float(b) / total)
+    return '#%02x%02x%02x' % tuple(int(round(c)) for c in color)
+
+
+def get_dhash(img):
+    """
+    Returns 64 bit difference hash of PIL image ``img``: the image is reduced to
+    9x8 grey pixels and every bit tells whether a pixel is brighter than its left
+    neighbour. Resized or re-encoded copies get hashes differing in a few bits.
+    The hash is returned signed, as stored in a BigIntegerField.
+    """
+    small = img.convert('L').resize((9, 8), PILImage.ANTIALIAS)
+    if numpy is not None:
+        pixels = numpy.asarray(small, dtype=numpy.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten().astype(numpy.uint64)
+        value = int((bits << numpy.arange(64, dtype=numpy.uint64)).sum())
+    else:
+        pixels = list(small.getdata())
+        value = 0
+        for i in range(64):
+            row, col = divmod(i, 8)
+            if pixels[row * 9 + col + 1] > pixels[row * 9 + col]:
+                value |= 1 << i
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def make_placeholder(img):
+    """
+    Returns the inline preview, a tiny JPEG data URI of a few hundred bytes,
+    and the dominant colour of decoded RGB PIL image ``img``
+    """
+    sample = img.copy()
+    sample.thumbnail((COLOR_SAMPLE_SIZE, COLOR_SAMPLE_SIZE), PILImage.ANTIALIAS)
+    small = sample.copy()
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), PILImage.ANTIALIAS)
+    buf = StringIO()
+    small.save(buf, 'JPEG', quality=PLACEHOLDER_QUALITY)
+    return {
+        'placeholder': 'data:image/jpeg;base64,%s' % base64.b64encode(buf.getvalue()),
+        'dominant_color': get_dominant_color(sample),
+    }
+
+
+def decode_image_file(f):
+    """
+    Decodes the image from file-like ``f`` once and returns a JPEG encoded
+    ContentFile scaled to fit RESIZE_SIZE, with the metadata of the upload.
+
+    The copy is turned upright by the EXIF orientation and written as an
+    optimised progressive JPEG without EXIF and embedded previews, so thumbnails
+    need not rotate it.
+    """
+    quality = getattr(settings, 'IMAGESTORE_IMAGE_QUALITY', 95)
+    f.seek(0)
+    img = PILImage.open(f)
+    exif = get_exif(img)
+    metadata = extract_metadata(img, exif=exif)
+    if img.format == 'JPEG':
+        # Let the decoder skip the detail we are going to throw away
+        img.draft('RGB', RESIZE_SIZE)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    width, height = img.size
+    factor = min(float(RESIZE_SIZE[0]) / width, float(RESIZE_SIZE[1]) / height)
+    if factor < 1 or (factor > 1 and UPSCALE):
+        size = (max(int(round(width * factor)), 1), max(int(round(height * factor)), 1))
+        img = img.resize(size, PILImage.ANTIALIAS)
+    # Rotating after the resize moves fewer pixels, RESIZE_SIZE is square
+    for method in ORIENTATION_TRANSPOSE.get(exif.get(EXIF_ORIENTATION), ()):
+        img = img.transpose(method)
+    buf = StringIO()
+    img.save(buf, 'JPEG', quality=quality, optimize=True, progressive=True)
+    content = ContentFile(buf.getvalue())
+    # Metadata describes the stored master, which is always a JPEG
+    metadata.update(width=img.size[0], height=img.size[1], file_size=content.size, format='JPEG')
+    metadata.update(make_placeholder(img))
+    metadata['dhash'] = get_dhash(img)
+    return content, metadata
+
+
+def set_metadata(image, metadata):
+    for name in METADATA_FIELDS:
+        setattr(image, name, metadata[name])
+
+
+def copy_metadata(source, image):
+    for name in METADATA_FIELDS:
+        setattr(image, name, getattr(source, name))
+
+
+def normalise_image(image):
+    """
+    Replaces the file of ``image`` with a copy resized to fit 1000x1000 and
+    fills its METADATA_FIELDS. The caller is responsible for saving the row.
+
+    A file that is not committed yet (a fresh upload) is resized in memory
+    and written to the storage once. A stored file is read back, replaced
+    by the resized copy and deleted.
+    """
+    field = image.image
+    name = '%s.jpg' % os.path.splitext(os.path.basename(field.name))[0]
+    if field._committed:
+        old_name = field.name
+        field.open('rb')
+        try:
+            content, metadata = decode_image_file(field)
+        finally:
+            field.close()
+        field.save(name, content, save=False)
+        # Thumbnails of the original may have been served while it was pending
+        delete(old_name)
+    else:
+        content, metadata = decode_image_file(field.file)
+        field.save(name, content, save=False)
+    set_metadata(image, metadata)
+
+
+def parse_variant(spec):
+    """
+    Parses variant spec like "120x120 crop quality=80" to the geometry
+    and options for sorl get_thumbnail.
+    """
+    bits = spec.split()
+    options = {}
+    for bit in bits[1:]:
+        if '=' in bit:
+            key, value = bit.split('=', 1)
+            options[key] = value.isdigit() and int(value) or value
+        elif bit == 'crop':
+            options['crop'] = 'center'
+        else:
+            options[bit] = True
+    return bits[0], options
+
+
+def generate_variants(image):
+    """
+    Generates thumbnails for every IMAGESTORE_VARIANTS spec from the stored
+    file of ``image`` and returns their urls and sizes keyed by variant name.
+    """
+    variants = {}
+    for name, spec in VARIANTS.items():
+        geometry, options = parse_variant(spec)
+        thumbnail = get_thumbnail(image.image, geometry, **options)
+        variants[name] = {'url': thumbnail.url, 'width': thumbnail.width, 'height': thumbnail.height}
+    return variants
+
+
+def process_image(image_id, retries=3, interval=0.5):
+    """
+    Worker entry point: normalises the stored image and records the outcome in
+    its status field. The row is written with update() so that concurrent edits
+    of title, tags, etc. made while the image was processed are not lost.
+
+    The image is claimed by switching it from pending to processing with a single
+    UPDATE, so only one worker processes it. Returns True if the image was
+    processed, False if it failed and None if it was not pending.
+    """
+    from imagestore.models import Image
+    from imagestore.cache import invalidate_album
+    for attempt in range(retries):
+        if Image.objects.filter(pk=image_id, status=STATUS_PENDING).update(status=STATUS_PROCESSING):
+            break
+        if Image.objects.filter(pk=image_id).exists():
+            # Claimed by another worker, or processed already
+            return None
+        # The upload transaction may not be committed yet
+        time.sleep(interval)
+    else:
+        logger.warning('Image %s was not found, it is left to imagestore_process if it is still pending', image_id)
+        return None
+    image = Image.objects.get(pk=image_id)
+    try:
+        normalise_image(image)
+        image.set_variants(generate_variants(image))
+    except Exception:
+        logger.exception('Failed to process image %s', image_id)
+        Image.objects.filter(pk=image_id).update(status=STATUS_FAILED)
+        return False
+    values = dict((name, getattr(image, name)) for name in METADATA_FIELDS)
+    Image.objects.filter(pk=image_id).update(image=image.image.name, variants=image.variants,
+                                             status=STATUS_READY, **values)
+    invalidate_album(image.album_id)
+    return True
+
+
+def wait_for_image(image_id, timeout=30, interval=0.5):
+    """
+    Polls the status of the image until it is processed or ``timeout`` seconds pass.
+    Returns the last seen status, or None if the image was deleted.
+    """
+    from imagestore.models import Image
+    deadline = time.time() + timeout
+    while True:
+        status = Image.objects.filter(pk=image_id).values_list('status', flat=True)[:1]
+        if not status:
+            return None
+        status = status[0]
+        if status in (STATUS_READY, STATUS_FAILED) or time.time() >= deadline:
+            return status
+        time.sleep(interval)
+
+
+def _close_connection():
+    # Worker threads and forked processes must not share the web request connection
+    connection.close()
+
+
+def _forget_connection():
+    # The forked process inherits the socket of the web request's connection.
+    # Closing it would end the parent's session, so only drop the handle and
+    # let the process open its own connection.
+    connection.connection = None
+
+
+def _run_task(func, *args):
+    try:
+        return func(*args)
+    finally:
+        _close_connection()
+
+
+class SyncBackend(object):
+    """
+    Runs the tasks inline on the request thread. This is the default behaviour.
+    """
+    deferred = False
+    # Whether submitted tasks run off the request
+    runs_in_background = False
+
+    def submit(self, func, *args):
+        return func(*args)
+
+
+class ThreadPoolBackend(object):
+    """
+    Runs the tasks in a pool of IMAGESTORE_PROCESSING_WORKERS threads of the web process.
+    """
+    deferred = True
+    runs_in_background = True
+
+    def __init__(self, workers=PROCESSING_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = self.create_pool()
+            return self._pool
+
+    def create_pool(self):
+        return ThreadPool(self.workers)
+
+    def submit(self, func, *args):
+        return self.get_pool().apply_async(_run_task, (func,) + args)
+
+
+class ProcessPoolBackend(ThreadPoolBackend):
+    """
+    Runs the tasks in a pool of IMAGESTORE_PROCESSING_WORKERS processes,
+    so resizing does not compete with the web threads for the GIL.
+    """
+    def create_pool(self):
+        return Pool(self.workers, initializer=_forget_connection)
+
+
+class QueueBackend(object):
+    """
+    Leaves new images pending. They are processed by the consumer started with
+    ``manage.py imagestore_process`` so the web process does not resize at all.
+    Other tasks are run inline.
+    """
+    deferred = True
+    runs_in_background = False
+
+    def submit(self, func, *args):
+        if func is process_image:
+            return None
+        return func(*args)
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = load_class(PROCESSING_BACKEND, 'IMAGESTORE_PROCESSING_BACKEND')()
+    return _backend
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from django.conf import settings
+from django.db.models import F, Count
+from mezzanine.blog.models import BlogPost
+
+from imagestore.models import Image
+
+# Images of a vendor are counted in num_images of their blog post
+MAX_IMAGES_PER_VENDOR = getattr(settings, 'MAX_IMAGES_PER_VENDOR', 10)
+RECONCILE_BATCH = 500
+
+
+def reserve_images(blog_post, count=1, limit=MAX_IMAGES_PER_VENDOR):
+    """
+    Adds ``count`` images to the counter of ``blog_post`` unless that would
+    cross ``limit``. The check and the increment are a single UPDATE, so
+    concurrent uploads can not race past the limit.
+    Returns True if the images were reserved.
+    """
+    return bool(BlogPost.objects.filter(pk=blog_post.pk, num_images__lte=limit - count)
+                                .update(num_images=F('num_images') + count))
+
+
+def release_images(blog_post, count=1):
+    """
+    Subtracts ``count`` deleted images from the counter of ``blog_post``
+    """
+    if not count:
+        return
+    if not BlogPost.objects.filter(pk=blog_post.pk, num_images__gte=count)\
+                           .update(num_images=F('num_images') - count):
+        # The counter has drifted, do not let it go negative
+        BlogPost.objects.filter(pk=blog_post.pk).update(num_images=0)
+
+
+def reconcile_counters():
+    """
+    Recomputes num_images of all blog posts from the Image table, with one
+    UPDATE per distinct image count. Returns number of updated blog posts.
+    """
+    users_by_count = {}
+    for row in Image.objects.values('user').annotate(count=Count('id')).order_by():
+        users_by_count.setdefault(row['count'], []).append(row['user'])
+    updated = 0
+    for count, user_ids in users_by_count.items():
+        # Keep the IN lists within the parameter limits of the databases
+        for i in range(0, len(user_ids), RECONCILE_BATCH):
+            updated += BlogPost.objects.filter(user__in=user_ids[i:i + RECONCILE_BATCH])\
+                                       .exclude(num_images=count).update(num_images=count)
+    updated += BlogPost.objects.exclude(user__in=Image.objects.filter(user__isnull=False).values('user'))\
+                               .exclude(num_images=0).update(num_images=0)
+    return updated
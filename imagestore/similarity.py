@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Count, Max
+
+from imagestore.models import Image
+
+# Images whose hashes differ in at most this many of 64 bits are near-duplicates
+SIMILAR_DISTANCE = getattr(settings, 'IMAGESTORE_SIMILAR_DISTANCE', 8)
+# Number of users whose BK-trees are kept in memory of the process
+SIMILAR_CACHE_USERS = getattr(settings, 'IMAGESTORE_SIMILAR_CACHE_USERS', 32)
+
+MASK = (1 << 64) - 1
+
+
+def hamming(a, b):
+    return bin((a ^ b) & MASK).count('1')
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of 64 bit hashes. Searching within distance d visits only
+    the subtrees whose edge distance is within d of the distance to their parent,
+    which for small d is a tiny part of the tree.
+    """
+    def __init__(self):
+        # Node is [hash, ids of images with the hash, {distance: child node}]
+        self.root = None
+
+    def add(self, value, image_id):
+        value &= MASK
+        if self.root is None:
+            self.root = [value, [image_id], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(image_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [image_id], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """
+        Returns (distance, image id) pairs of hashes within ``max_distance`` of ``value``
+        """
+        value &= MASK
+        found = []
+        stack = self.root and [self.root] or []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, image_id) for image_id in node[1])
+            for edge, child in node[2].iteritems():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+_trees = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_tree(user):
+    """
+    Returns BK-tree of hashes of the user's images. The tree is kept in memory and
+    checked against the number and the newest of the user's hashed images: new
+    uploads are added to it, other changes rebuild it.
+    """
+    images = Image.objects.filter(user=user, dhash__isnull=False)
+    stamp = images.aggregate(count=Count('id'), last=Max('id'))
+    stamp = (stamp['count'], stamp['last'] or 0)
+    with _lock:
+        cached = _trees.pop(user.pk, None)
+    if cached is not None and cached[0] != stamp:
+        (count, last), tree = cached
+        added = list(images.filter(pk__gt=last).order_by('id').values_list('id', 'dhash'))
+        if added and count + len(added) == stamp[0] and added[-1][0] == stamp[1]:
+            for image_id, value in added:
+                tree.add(value, image_id)
+            cached = (stamp, tree)
+        else:
+            cached = None
+    if cached is None:
+        tree = BKTree()
+        for image_id, value in images.values_list('id', 'dhash').iterator():
+            tree.add(value, image_id)
+        cached = (stamp, tree)
+    with _lock:
+        _trees[user.pk] = cached
+        while len(_trees) > SIMILAR_CACHE_USERS:
+            _trees.popitem(last=False)
+    return cached[1]
+
+
+def find_similar(image, max_distance=SIMILAR_DISTANCE):
+    """
+    Returns images of the owner of ``image`` that look like it, closest first,
+    as (distance, image) pairs
+    """
+    if image.dhash is None or image.user_id is None:
+        return []
+    found = [(distance, image_id) for distance, image_id
+             in get_tree(image.user).search(image.dhash, max_distance) if image_id != image.pk]
+    images = Image.objects.select_related('album').in_bulk([image_id for distance, image_id in found])
+    return [(distance, images[image_id]) for distance, image_id in sorted(found) if image_id in images]
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# vim:fileencoding=utf-8
+
+__author__ = 'zeus'
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from tagging.utils import parse_tag_input
+
+from imagestore.models import Image, ImageTag
+
+FORCE_LOWERCASE_TAGS = getattr(settings, 'FORCE_LOWERCASE_TAGS', False)
+
+
+def parse_tags(tags):
+    """
+    Returns names of the tags in TagField value ``tags``, as django-tagging stores them
+    """
+    names = parse_tag_input(tags or '')
+    if FORCE_LOWERCASE_TAGS:
+        names = [name.lower() for name in names]
+    return set(names)
+
+
+def sync_image_tags(image):
+    """
+    Updates index rows of ``image`` to its tags
+    """
+    names = parse_tags(image.tags)
+    current = set(ImageTag.objects.filter(image=image.pk).values_list('tag', flat=True))
+    if current - names:
+        ImageTag.objects.filter(image=image.pk, tag__in=current - names).delete()
+    if names - current:
+        ImageTag.objects.bulk_create([ImageTag(image_id=image.pk, tag=name) for name in names - current])
+
+
+def tagged_images(names, match_all=True, images=None):
+    """
+    Filters ``images`` (all images by default) to the ones tagged with all
+    of the tags ``names``, or with any of them when ``match_all`` is False
+    """
+    if images is None:
+        images = Image.objects.all()
+    names = set(names)
+    if not match_all:
+        return images.filter(pk__in=ImageTag.objects.filter(tag__in=names).values('image'))
+    # Every filter() on the relation makes its own join, each one an index lookup on (tag, image)
+    for name in names:
+        images = images.filter(tag_index__tag=name)
+    return images
+
+
+#noinspection PyUnusedLocal
+def update_tag_index(instance, **kwargs):
+    sync_image_tags(instance)
+
+
+def connect_tag_signals():
+    post_save.connect(update_tag_index, Image)
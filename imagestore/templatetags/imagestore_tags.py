@@ -72,4 +72,28 @@ def render_minimal_album_update_form(context, album_id):
 def min_image_order(album):
     if album:
         return album.images.all().aggregate(Min('order'))['order__min']
-    return ''
\ No newline at end of file
+    return ''
+
+@register.filter
+def variant_url(image, name):
+    """
+    Usage: {{ image|variant_url:"thumb" }}
+    """
+    if image:
+        return image.get_variant_url(name)
+    return ''
+
+@register.filter
+def placeholder_style(image):
+    """
+    Paints the dominant colour and the blurred preview of the image until it loads.
+    Usage: <img style="{{ image|placeholder_style }}" loading="lazy" ...>
+    """
+    if not image:
+        return ''
+    styles = []
+    if image.dominant_color:
+        styles.append('background-color: %s' % image.dominant_color)
+    if image.placeholder:
+        styles.append('background-image: url(%s); background-size: cover' % image.placeholder)
+    return '; '.join(styles)
@@ -8,6 +8,7 @@ from django.test.client import Client
 from django.core.urlresolvers import reverse
 from models import *
 import os
+import json
 from django.contrib.auth.models import User
 from django.db import models
 
@@ -175,4 +176,216 @@ class ImagestoreTest(TestCase):
         response = self.client.get(reverse('imagestore:index'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['object_list'][0].name, 'a1')
-        self.assertEqual(response.context['object_list'][1].name, 'b2')
\ No newline at end of file
+        self.assertEqual(response.context['object_list'][1].name, 'b2')
+
+    def test_image_status(self):
+        self._upload_test_image()
+        image = Image.objects.get(user__username='zeus')
+        self.assertTrue(image.is_ready)
+        response = self.client.get(reverse('imagestore:image-status', kwargs={'pk': image.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['status'], 'ready')
+
+    def test_album_head_on_index(self):
+        self._upload_test_image()
+        image = Image.objects.get(user__username='zeus')
+        response = self.client.get(reverse('imagestore:index'))
+        self.assertEqual(response.status_code, 200)
+        album = response.context['album_list'][0]
+        self.assertEqual(album.get_head(), image)
+        # Rendering must not write the head back
+        self.assertEqual(Album.objects.get(id=album.id).head_id, None)
+
+    def test_image_variants(self):
+        self._upload_test_image()
+        image = Image.objects.get(user__username='zeus')
+        variants = image.get_variants()
+        self.assertEqual(variants['thumb']['width'], 120)
+        self.assertEqual(image.get_variant_url('thumb'), variants['thumb']['url'])
+
+    def test_update_album_order(self):
+        images = []
+        for i in range(4):
+            self._upload_test_image()
+            img = Image.objects.order_by('-id')[0]
+            img.order = i
+            img.save()
+            images.append(img.id)
+        response = self.client.post(reverse('imagestore:update-album-order', kwargs={'image_id': images[0], 'new_order': 2}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Image.objects.values_list('id', flat=True)), [images[1], images[2], images[0], images[3]])
+        response = self.client.post(reverse('imagestore:reorder-album', kwargs={'album_id': self.album.id}),
+                                    {'ids': [images[3], images[2]]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Image.objects.values_list('id', flat=True)), [images[3], images[2], images[1], images[0]])
+
+    def test_move_to_album_head(self):
+        from imagestore import ordering
+        self.client.login(username='zeus', password='zeus')
+        Image.objects.bulk_create([Image(album=self.album, user=self.user, image='test.jpg', order=i * ordering.ORDER_STEP)
+                                   for i in range(3)])
+        ids = list(Image.objects.values_list('id', flat=True))
+        for image_id in (ids[2], ids[1]):
+            head = Image.objects.values_list('order', flat=True)[0]
+            response = self.client.post(reverse('imagestore:update-album-order', kwargs={'image_id': image_id, 'new_order': head}))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Image.objects.values_list('id', flat=True)), [ids[1], ids[2], ids[0]])
+        self.assertTrue(min(Image.objects.values_list('order', flat=True)) >= 0)
+
+    def test_render_after_image_without_date(self):
+        Image.objects.bulk_create([Image(album=self.album, user=self.user, image='test.jpg') for i in range(3)])
+        first, second, third = Image.objects.order_by('id')
+        # Images uploaded before the date was recorded are rendered last
+        Image.objects.filter(pk__in=[first.pk, second.pk]).update(created=None)
+        url = reverse('imagestore:render_min_album', kwargs={'album_id': self.album.id, 'offset': 0})
+        response = self.client.get(url)
+        self.assertEqual(list(response.context['image_list']), [third, second, first])
+        response = self.client.get(url + '?after=%s' % second.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['image_list']), [first])
+
+    def test_zip_import(self):
+        import zipfile
+        from StringIO import StringIO
+        from django.core.files.base import ContentFile
+        buf = StringIO()
+        archive = zipfile.ZipFile(buf, 'w')
+        archive.writestr('good.jpg', self.image_file.read())
+        archive.writestr('broken.jpg', 'not an image')
+        archive.close()
+        upload = AlbumUpload(album=self.album)
+        upload.zip_file.save('test.zip', ContentFile(buf.getvalue()), save=False)
+        upload.save()
+        # The corrupt member is skipped, the rest is imported
+        self.assertEqual(self.album.images.count(), 1)
+        self.assertTrue(self.album.images.get().is_ready)
+
+    def test_chunked_upload(self):
+        self.client.login(username='zeus', password='zeus')
+        response = self.client.post(reverse('imagestore:chunked-upload'), {'filename': 'test_img.jpg'})
+        self.assertEqual(response.status_code, 201)
+        upload_id = json.loads(response.content)['upload_id']
+        url = reverse('imagestore:chunked-upload-append', kwargs={'upload_id': upload_id})
+        data = self.image_file.read()
+        middle = len(data) // 2
+        response = self.client.post(url + '?offset=0', data[:middle], content_type='application/octet-stream')
+        self.assertEqual(json.loads(response.content)['offset'], middle)
+        # Resending a chunk is refused with the offset to resume from
+        response = self.client.post(url + '?offset=0', data[:middle], content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(url + '?offset=%d' % middle, data[middle:], content_type='application/octet-stream')
+        self.assertEqual(json.loads(response.content)['offset'], len(data))
+        self.client.post(reverse('imagestore:chunked-upload-finish', kwargs={'upload_id': upload_id}),
+                         {'album': self.album.id, 'title': 'chunked'})
+        self.assertEqual(Image.objects.filter(title='chunked').count(), 1)
+        self.assertEqual(ChunkedUpload.objects.count(), 0)
+
+    def test_image_quota(self):
+        from mezzanine.blog.models import BlogPost
+        from imagestore import quota
+        blog_post = BlogPost.objects.create(user=self.user, title='vendor')
+        self.assertTrue(quota.reserve_images(blog_post, limit=1))
+        self.assertFalse(quota.reserve_images(blog_post, limit=1))
+        quota.release_images(blog_post, 5)
+        self.assertEqual(BlogPost.objects.get(pk=blog_post.pk).num_images, 0)
+        Image.objects.bulk_create([Image(album=self.album, user=self.user, image='test.jpg')])
+        self.assertEqual(quota.reconcile_counters(), 1)
+        self.assertEqual(BlogPost.objects.get(pk=blog_post.pk).num_images, 1)
+
+    def test_soft_delete(self):
+        from imagestore import deletion
+        Image.objects.bulk_create([Image(album=self.album, user=self.user, image='test.jpg')])
+        image = Image.objects.get(album=self.album)
+        deletion.soft_delete_image(image)
+        self.assertEqual(self.album.images.count(), 0)
+        self.assertEqual(Image.all_objects.filter(is_deleted=True).count(), 1)
+        deletion.sweep()
+        self.assertEqual(Image.all_objects.count(), 0)
+        self.assertEqual(FileTombstone.objects.count(), 0)
+
+    def test_duplicate_upload(self):
+        self._upload_test_image()
+        self._upload_test_image()
+        first, second = Image.objects.filter(user__username='zeus').order_by('id')
+        self.assertTrue(first.content_hash)
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertEqual(first.image.name, second.image.name)
+        # Files of other users are not shared
+        from imagestore.processing import find_duplicate
+        other = User.objects.create_user('hera', 'hera@example.com', 'hera')
+        self.assertEqual(find_duplicate(first.content_hash, other.id), None)
+
+    def test_image_metadata(self):
+        self._upload_test_image()
+        image = Image.objects.get(user__username='zeus')
+        self.assertTrue(image.width and image.height)
+        self.assertEqual(image.file_size, image.image.size)
+        self.assertEqual(image.format, 'JPEG')
+        self.assertTrue(image.placeholder.startswith('data:image/jpeg;base64,'))
+        self.assertEqual(len(image.dominant_color), 7)
+
+    def _jpeg_with_orientation(self, orientation):
+        """
+        Returns 40x20 JPEG with red top left quarter and EXIF orientation tag
+        """
+        import struct
+        from StringIO import StringIO
+        try:
+            import Image as PILImage
+        except ImportError:
+            from PIL import Image as PILImage
+        img = PILImage.new('RGB', (40, 20), (0, 0, 255))
+        img.paste((255, 0, 0), (0, 0, 20, 10))
+        buf = StringIO()
+        img.save(buf, 'JPEG', quality=95)
+        data = buf.getvalue()
+        # Little endian TIFF with IFD0 holding the Orientation SHORT only
+        tiff = 'II*\x00' + struct.pack('<IH', 8, 1) + struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0) + struct.pack('<I', 0)
+        exif = 'Exif\x00\x00' + tiff
+        return data[:2] + '\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif + data[2:]
+
+    def test_exif_orientation(self):
+        from StringIO import StringIO
+        from imagestore.processing import decode_image_file
+        try:
+            import Image as PILImage
+        except ImportError:
+            from PIL import Image as PILImage
+        # Orientation 6 is rotated clockwise, 5 is transposed: the red quarter goes right or stays left
+        for orientation, red_x, blue_x in ((6, 0.75, 0.25), (5, 0.25, 0.75)):
+            content, metadata = decode_image_file(StringIO(self._jpeg_with_orientation(orientation)))
+            master = PILImage.open(StringIO(content.read()))
+            width, height = master.size
+            self.assertEqual((width, height), (metadata['width'], metadata['height']))
+            self.assertEqual(height, width * 2)
+            self.assertTrue(master.getpixel((int(width * red_x), height // 4))[0] > 128)
+            self.assertTrue(master.getpixel((int(width * blue_x), height // 4))[0] < 128)
+            # Master is a progressive JPEG without EXIF
+            self.assertTrue(master.info.get('progressive'))
+            self.assertFalse('exif' in master.info)
+
+    def test_similar_images(self):
+        from imagestore.similarity import BKTree
+        tree = BKTree()
+        for image_id, value in enumerate([0, 1, 3, -1, 1 << 40]):
+            tree.add(value, image_id)
+        self.assertEqual(sorted(tree.search(0, 2)), [(0, 0), (1, 1), (1, 4), (2, 2)])
+        self._upload_test_image()
+        image = Image.objects.get(user__username='zeus')
+        self.assertTrue(image.dhash is not None)
+        response = self.client.get(reverse('imagestore:image-similar', kwargs={'pk': image.id}))
+        self.assertEqual(json.loads(response.content)['similar'], [])
+
+    def test_tag_index(self):
+        from imagestore.tagindex import tagged_images
+        Image.objects.bulk_create([Image(album=self.album, user=self.user, image='test.jpg')])
+        image = Image.objects.get(album=self.album)
+        image.tags = 'one, two'
+        image.save()
+        self.assertEqual(sorted(image.tag_index.values_list('tag', flat=True)), ['one', 'two'])
+        self.assertEqual(list(tagged_images(['one', 'two'])), [image])
+        self.assertEqual(list(tagged_images(['one', 'three'])), [])
+        self.assertEqual(list(tagged_images(['one', 'three'], match_all=False)), [image])
+        image.tags = 'two'
+        image.save()
+        self.assertEqual(list(image.tag_index.values_list('tag', flat=True)), ['two'])
@@ -1,6 +1,6 @@
 from django.conf.urls.defaults import *
 from tagging.models import Tag
-from views import editImage, updateAlbumOrder, AlbumListView, ImageListView, ImageListTemplateView, ImageListMinView, ImageListExView, UpdateImage, UpdateAlbum, CreateImage, CreateAlbum, DeleteImage, DeleteAlbum, ImageView
+from views import editImage, imageStatus, similarImages, updateAlbumOrder, reorderAlbum, startChunkedUpload, appendChunkedUpload, FinishChunkedUpload, AlbumListView, ImageListView, ImageListTemplateView, ImageListMinView, ImageListExView, UpdateImage, UpdateAlbum, CreateImage, CreateAlbum, DeleteImage, DeleteAlbum, ImageView
 
 from fancy_autocomplete.views import AutocompleteSite
 autocomletes = AutocompleteSite()
@@ -20,6 +20,7 @@ urlpatterns = patterns('imagestore.views',
 
                        url(r'^album/add/$', CreateAlbum.as_view(), name='create-album'),
                        url(r'^album/update/order/(?P<image_id>\d+)/(?P<new_order>\d+)/$', updateAlbumOrder, name='update-album-order'),
+                       url(r'^album/(?P<album_id>\d+)/reorder/$', reorderAlbum, name='reorder-album'),
                        url(r'^album/(?P<album_id>\d+)/$', ImageListView.as_view(), name='album'),
                        url(r'^post/album/(?P<album_id>\d+)/$', ImageListTemplateView.as_view(), name='render_album'),
                        url(r'^render/album/(?P<album_id>\d+)/(?P<offset>\d+)/$', ImageListMinView.as_view(), name='render_min_album'),
@@ -33,6 +34,9 @@ urlpatterns = patterns('imagestore.views',
                        url(r'^user/(?P<username>.+?)/$', ImageListView.as_view(), name='user-images'),
 
                        url(r'^upload/$', CreateImage.as_view(), name='upload'),
+                       url(r'^upload/chunked/$', startChunkedUpload, name='chunked-upload'),
+                       url(r'^upload/chunked/(?P<upload_id>[0-9a-f]{32})/$', appendChunkedUpload, name='chunked-upload-append'),
+                       url(r'^upload/chunked/(?P<upload_id>[0-9a-f]{32})/finish/$', FinishChunkedUpload.as_view(), name='chunked-upload-finish'),
 
                        url(r'^image/(?P<pk>\d+)/$', ImageView.as_view(), name='image'),
                        url(r'^album/(?P<album_id>\d+)/image/(?P<pk>\d+)/$', ImageView.as_view(), name='image-album'),
@@ -40,6 +44,8 @@ urlpatterns = patterns('imagestore.views',
                        url(r'^image/(?P<pk>\d+)/delete/$', DeleteImage.as_view(), name='delete-image'),
                        url(r'^image/(?P<pk>\d+)/update/$', UpdateImage.as_view(), name='update-image'),
                        url(r'^image/(?P<image_id>\d+)/edit/$', editImage, name='edit-image'),
+                       url(r'^image/(?P<pk>\d+)/status/$', imageStatus, name='image-status'),
+                       url(r'^image/(?P<pk>\d+)/similar/$', similarImages, name='image-similar'),
 
                        url(r'^autocomplete/(.*)/$', autocomletes, name='autocomplete')
                        )
@@ -10,6 +10,7 @@ from django.utils.importlib import import_module
 from django.conf import settings
 
 UPLOAD_TO = getattr(settings, 'IMAGESTORE_UPLOAD_TO', 'imagestore/')
+FILE_LAYOUT = getattr(settings, 'IMAGESTORE_FILE_LAYOUT', 'imagestore.utils.legacy_file_layout')
 
 def load_class(class_path, setting_name=None):
     """
@@ -62,8 +63,29 @@ def get_model_string(model_name):
         klass = load_class(class_path)
         return '%s.%s' % (klass._meta.app_label, klass.__name__)
 
+def legacy_file_layout(instance, filename):
+    """
+    Places the file in the directory of its album, <user>/<album name>_<album id>/<filename>
+    """
+    return os.path.join(UPLOAD_TO, "user_%d/%s_%d" % (instance.user.id, instance.album.name, instance.album.id), filename)
+
+def sharded_file_layout(instance, filename):
+    """
+    Spreads files over 65536 directories by the first four characters of the
+    (random) filename, <ab>/<cd>/<filename>. Renaming or moving albums does not
+    move the files.
+    """
+    return os.path.join(UPLOAD_TO, filename[:2], filename[2:4], filename)
+
+_file_layout = None
+
+def get_file_layout():
+    global _file_layout
+    if _file_layout is None:
+        _file_layout = load_class(FILE_LAYOUT, 'IMAGESTORE_FILE_LAYOUT')
+    return _file_layout
+
 def get_file_path(instance, filename):
     ext = filename.split('.')[-1]
     filename = "%s.%s" % (uuid.uuid4(), ext)
-    Path = os.path.join(UPLOAD_TO, "user_%d/%s_%d" % (instance.user.id, instance.album.name, instance.album.id))
-    return os.path.join(Path, filename)
\ No newline at end of file
+    return get_file_layout()(instance, filename)
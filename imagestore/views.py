@@ -1,33 +1,43 @@
 import os
+import re
+import operator
 from django import forms
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.utils.decorators import method_decorator
-from imagestore.models import Album, Image
+from imagestore.models import Album, Image, ChunkedUpload
+from imagestore.models.upload import UploadTooLarge
 from imagestore.models import image_applabel, image_classname
 from imagestore.models import album_applabel, album_classname
 from django.shortcuts import get_object_or_404
-from django.http import Http404, HttpResponseRedirect, HttpResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
+from django.core.files.uploadedfile import UploadedFile
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import permission_required
 from django.contrib.auth.decorators import login_required
+from django.contrib import messages
+from django.views.decorators.http import require_POST
 from django.utils.translation import ugettext_lazy as _
 from django.utils import simplejson
 from django.utils.simplejson import dumps
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 from django.template import RequestContext
-from django.db.models import Max
+from django.db import connection, transaction
 
 from mezzanine.utils.views import render
 
-from tagging.models import TaggedItem
+from tagging.models import Tag
 from tagging.utils import get_tag
 from utils import load_class
+import ordering
+import quota
+import deletion
+import similarity
+import tagindex
+from imagestore.cache import get_album_listing, get_album_version, get_blog_post, ALBUM_CACHE_TIMEOUT
 from django.db.models import Q
 from actstream import action
-from mezzanine.blog.models import BlogPost
-from sorl.thumbnail import delete
 from actstream.models import Action
 from django.contrib.contenttypes.models import ContentType
 from userProfile.views import deleteObject
@@ -46,6 +56,10 @@ IMAGESTORE_IMAGES_ON_PAGE = getattr(settings, 'IMAGESTORE_IMAGES_ON_PAGE', 20)
 
 IMAGESTORE_ON_PAGE = getattr(settings, 'IMAGESTORE_ON_PAGE', 20)
 
+IMAGESTORE_RENDER_LIMIT = getattr(settings, 'IMAGESTORE_RENDER_LIMIT', IMAGESTORE_IMAGES_ON_PAGE)
+
+CHUNKED_UPLOAD_MAX_SIZE = getattr(settings, 'IMAGESTORE_CHUNKED_UPLOAD_MAX_SIZE', 50 * 1024 * 1024)
+
 ImageForm = load_class(getattr(settings, 'IMAGESTORE_IMAGE_FORM', 'imagestore.forms.ImageForm'))
 AlbumForm = load_class(getattr(settings, 'IMAGESTORE_ALBUM_FORM', 'imagestore.forms.AlbumForm'))
 
@@ -80,6 +94,35 @@ class AjaxableResponseMixin(object):
 		else:
 			return response
 
+def with_first_image_id(albums):
+	"""
+	Annotates albums with the id of their first image by (order, id)
+	"""
+	qn = connection.ops.quote_name
+	image_opts = Image._meta
+	sql = 'SELECT %(id)s FROM %(image)s WHERE %(image)s.%(album_id)s = %(album)s.%(pk)s AND %(is_deleted)s = %%s ORDER BY %(order)s, %(id)s LIMIT 1' % {
+		'id': qn(image_opts.pk.column),
+		'image': qn(image_opts.db_table),
+		'album_id': qn(image_opts.get_field('album').column),
+		'album': qn(Album._meta.db_table),
+		'pk': qn(Album._meta.pk.column),
+		'order': qn(image_opts.get_field('order').column),
+		'is_deleted': qn(image_opts.get_field('is_deleted').column),
+	}
+	return albums.extra(select={'first_image_id': sql}, select_params=(False,))
+
+def prefetch_album_heads(albums):
+	"""
+	Resolves heads of albums annotated by with_first_image_id with a single query
+	"""
+	albums = list(albums)
+	ids = [album.first_image_id for album in albums if not album.head_id and album.first_image_id]
+	images = ids and Image.objects.in_bulk(ids) or {}
+	for album in albums:
+		if not album.head_id:
+			album.set_head_cache(images.get(album.first_image_id))
+	return albums
+
 class AlbumListView(ListView):
 	context_object_name = 'album_list'
 	template_name = 'imagestore/album_list.html'
@@ -87,17 +130,18 @@ class AlbumListView(ListView):
 	allow_empty = True
 
 	def get_queryset(self):
-		albums = Album.objects.filter(is_public=True).select_related('head')
+		albums = with_first_image_id(Album.objects.filter(is_public=True).select_related('head'))
 		self.e_context = dict()
 		if 'username' in self.kwargs:
 			user = get_object_or_404(**{'klass': User, username_field: self.kwargs['username']})
 			albums = albums.filter(user=user)
 			self.e_context['view_user'] = user
-			self.e_context['max_images'] = getattr(settings, 'MAX_IMAGES_PER_VENDOR', 50)
+			self.e_context['max_images'] = quota.MAX_IMAGES_PER_VENDOR
 		return albums
 
 	def get_context_data(self, **kwargs):
 		context = super(AlbumListView, self).get_context_data(**kwargs)
+		context['object_list'] = context[self.context_object_name] = prefetch_album_heads(context['object_list'])
 		context.update(self.e_context)
 		return context
 
@@ -106,11 +150,20 @@ def get_images_queryset(self):
 	images = Image.objects.all()
 	self.e_context = dict()
 	if 'tag' in self.kwargs:
-		tag_instance = get_tag(self.kwargs['tag'])
-		if tag_instance is None:
+		# "a+b" lists images with both tags, "a,b" with any of them
+		tag = self.kwargs['tag']
+		names = [name for name in re.split(r'[+,]', tag) if name]
+		if len(names) == 1:
+			tag = get_tag(names[0])
+		elif not Tag.objects.filter(name__in=names).exists():
+			tag = None
+		if tag is None:
 			raise Http404(_('No Tag found matching "%s".') % self.kwargs['tag'])
-		self.e_context['tag'] = tag_instance
-		images = TaggedItem.objects.get_by_model(images, tag_instance)
+		self.e_context['tag'] = tag
+		images = tagindex.tagged_images(names, match_all=',' not in self.kwargs['tag'], images=images)
+		if self.request.GET.get('after'):
+			# Continue after the given image instead of counting pages over the whole tag
+			images = keyset_filter(images, self.request.GET['after'], ('order', 'id'))
 	if 'username' in self.kwargs:
 		user = get_object_or_404(**{'klass': User, username_field: self.kwargs['username']})
 		self.e_context['view_user'] = user
@@ -119,12 +172,76 @@ def get_images_queryset(self):
 		album = get_object_or_404(Album, id=self.kwargs['album_id'])
 		self.e_context['album'] = album
 		images = images.filter(album=album)
-		if (not album.is_public) and\
-		   (self.request.user != album.user) and\
-		   (not self.request.user.has_perm('imagestore.moderate_albums')):
-			raise PermissionDenied
+		check_album_access(self.request, album)
 	return images
 
+def check_album_access(request, album):
+	if (not album.is_public) and\
+	   (request.user != album.user) and\
+	   (not request.user.has_perm('imagestore.moderate_albums')):
+		raise PermissionDenied
+
+class CachedImageList(object):
+	"""
+	Images of the album listed by the cached ``ids``. Only the sliced page
+	is fetched from the database, with a single query, when it is used.
+	"""
+	def __init__(self, ids):
+		self.ids = ids
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __iter__(self):
+		return iter(self[:])
+
+	def __getitem__(self, index):
+		if not isinstance(index, slice):
+			return self[index:index + 1 or None][0]
+		return CachedImagePage(self.ids[index])
+
+class CachedImagePage(object):
+	"""
+	Images ``ids``, fetched on first use. A page whose grid comes from the
+	template fragment cache is never fetched.
+	"""
+	def __init__(self, ids):
+		self.ids = ids
+		self._images = None
+
+	def get_images(self):
+		if self._images is None:
+			images = Image.objects.in_bulk(self.ids)
+			self._images = [images[image_id] for image_id in self.ids if image_id in images]
+		return self._images
+
+	def __nonzero__(self):
+		return bool(self.ids)
+
+	def __len__(self):
+		return len(self.get_images())
+
+	def __iter__(self):
+		return iter(self.get_images())
+
+	def __getitem__(self, index):
+		return self.get_images()[index]
+
+def get_album_images(self):
+	"""
+	get_images_queryset for album pages, which are listed from the album cache
+	when IMAGESTORE_ALBUM_CACHE_TIMEOUT is set
+	"""
+	if not ALBUM_CACHE_TIMEOUT or set(self.kwargs) != set(['album_id']):
+		return get_images_queryset(self)
+	album = get_object_or_404(Album, id=self.kwargs['album_id'])
+	check_album_access(self.request, album)
+	ids = get_album_listing(album.pk)
+	if ids is None:
+		return get_images_queryset(self)
+	self.e_context = {'album': album}
+	return CachedImageList(ids)
+
 
 class ImageListView(ListView):
 	context_object_name = 'image_list'
@@ -132,7 +249,7 @@ class ImageListView(ListView):
 	paginate_by = getattr(settings, 'IMAGESTORE_IMAGES_ON_PAGE', 20)
 	allow_empty = True
 
-	get_queryset = get_images_queryset
+	get_queryset = get_album_images
 
 	def get_context_data(self, **kwargs):
 		context = super(ImageListView, self).get_context_data(**kwargs)
@@ -145,47 +262,99 @@ class ImageListTemplateView(ListView):
 	paginate_by = getattr(settings, 'IMAGESTORE_IMAGES_ON_PAGE', 20)
 	allow_empty = True
 
-	get_queryset = get_images_queryset
+	get_queryset = get_album_images
 
 	def get_context_data(self, **kwargs):
 		context = super(ImageListTemplateView, self).get_context_data(**kwargs)
 		context.update(self.e_context)
 		album = context['album']
 		user = album.user
-		blog_posts = BlogPost.objects.published(for_user=user).select_related().filter(user=user)
-		if blog_posts:
-			context["blog"] = blog_posts[0]
+		request_user = self.request.user
+		context['is_owner'] = request_user.is_authenticated() and\
+			(request_user == user or request_user.has_perm('imagestore.moderate_albums'))
+		if ALBUM_CACHE_TIMEOUT:
+			# Key of the cached grid fragment
+			context['album_cache_timeout'] = ALBUM_CACHE_TIMEOUT
+			context['album_version'] = get_album_version(album.pk)
+		blog_post = get_blog_post(user)
+		if blog_post:
+			context["blog"] = blog_post
 		return context
 
-class ImageListMinView(ListView):
+def order_images(images, ordering):
+	"""
+	Orders images by ``ordering`` with NULL values of nullable fields last,
+	whatever the database puts first
+	"""
+	qn = connection.ops.quote_name
+	select = {}
+	order_by = []
+	for field in ordering:
+		name = field.lstrip('-')
+		model_field = Image._meta.get_field(name)
+		if model_field.null:
+			select['%s_isnull' % name] = '%s.%s IS NULL' % (qn(Image._meta.db_table), qn(model_field.column))
+			order_by.append('%s_isnull' % name)
+		order_by.append(field)
+	return images.extra(select=select).order_by(*order_by)
+
+def keyset_filter(images, image_id, ordering):
+	"""
+	Filters images to the ones following image ``image_id`` when ordered by
+	``ordering`` (field names, prefixed with '-' for descending order) with
+	order_images. The last field has to be unique.
+	"""
+	names = [field.lstrip('-') for field in ordering]
+	try:
+		key = Image.objects.filter(pk=image_id).values(*names)[0]
+	except (IndexError, ValueError):
+		raise Http404
+	conditions = []
+	for i, field in enumerate(ordering):
+		name = names[i]
+		lookup = dict((key[prev] is None and ('%s__isnull' % prev, True) or (prev, key[prev])) for prev in names[:i])
+		if key[name] is None:
+			# NULLs go last, only the ones equal in the following fields come after
+			continue
+		following = dict(lookup)
+		following['%s__%s' % (name, field.startswith('-') and 'lt' or 'gt')] = key[name]
+		conditions.append(Q(**following))
+		if Image._meta.get_field(name).null:
+			lookup['%s__isnull' % name] = True
+			conditions.append(Q(**lookup))
+	if not conditions:
+		return images.none()
+	return order_images(images.filter(reduce(operator.or_, conditions)), ordering)
+
+
+class KeysetListMixin(object):
+	"""
+	Renders a chunk of IMAGESTORE_RENDER_LIMIT images, applied in SQL.
+	Client requests the next chunk with ``after`` GET parameter set to
+	the id of the last image it got.
+	"""
+	ordering = ('order', 'id')
+	limit = IMAGESTORE_RENDER_LIMIT
+
+	def get_chunk(self, images, offset=0):
+		after = self.request.GET.get('after')
+		if after:
+			images = keyset_filter(images, after, self.ordering)
+			offset = 0
+		else:
+			images = order_images(images, self.ordering)
+		return images[offset:offset + self.limit]
+
+
+class ImageListMinView(KeysetListMixin, ListView):
 	context_object_name = 'image_list'
 	template_name = 'imagestore/render_image_min_list.html'
-	#paginate_by = getattr(settings, 'IMAGESTORE_IMAGES_ON_PAGE', 20)
 	allow_empty = True
+	ordering = ('-created', '-id')
 
-	#get_queryset = get_images_queryset
 	def get_queryset(self):
-		images = Image.objects.all().order_by('-created')
-		self.e_context = dict()
-		if 'tag' in self.kwargs:
-			tag_instance = get_tag(self.kwargs['tag'])
-			if tag_instance is None:
-				raise Http404(_('No Tag found matching "%s".') % self.kwargs['tag'])
-			self.e_context['tag'] = tag_instance
-			images = TaggedItem.objects.get_by_model(images, tag_instance)
-		if 'username' in self.kwargs:
-			user = get_object_or_404(**{'klass': User, username_field: self.kwargs['username']})
-			self.e_context['view_user'] = user
-			images = images.filter(user=user)
-		if 'album_id' in self.kwargs:
-			album = get_object_or_404(Album, id=self.kwargs['album_id'])
-			self.e_context['album'] = album
-			images = images.filter(album=album)
-			if (not album.is_public) and\
-			   (self.request.user != album.user) and\
-			   (not self.request.user.has_perm('imagestore.moderate_albums')):
-				raise PermissionDenied
-		return images
+		offset = int(self.kwargs.get('offset', 0))
+		return self.get_chunk(get_images_queryset(self), offset)
 
 	def get_context_data(self, **kwargs):
 		context = super(ImageListMinView, self).get_context_data(**kwargs)
@@ -194,14 +363,15 @@ class ImageListMinView(ListView):
 		context["offset"] = int(offset)
 		return context
 
-class ImageListExView(ListView):
+class ImageListExView(KeysetListMixin, ListView):
 	context_object_name = 'image_list'
 	template_name = 'imagestore/render_image_ex_list.html'
-	#paginate_by = getattr(settings, 'IMAGESTORE_IMAGES_ON_PAGE', 20)
 	allow_empty = True
 
-	get_queryset = get_images_queryset
-				
+	def get_queryset(self):
+		exclude_id = int(self.kwargs.get('exclude', -1))
+		return self.get_chunk(get_images_queryset(self).exclude(id=exclude_id))
+
 	def get_context_data(self, **kwargs):
 		context = super(ImageListExView, self).get_context_data(**kwargs)
 		exclude_id= self.kwargs.get('exclude', -1)
@@ -231,32 +401,32 @@ class ImageView(DetailView):
 		context = super(ImageView, self).get_context_data(**kwargs)
 		image = context['image']
 
+		ids = None
+		if ALBUM_CACHE_TIMEOUT and set(self.kwargs) == set(['album_id', 'pk']):
+			ids = get_album_listing(self.kwargs['album_id'])
+		if ids and image.id in ids:
+			# Neighbours come from the cached album listing
+			position = ids.index(image.id)
+			next_id = position + 1 < len(ids) and ids[position + 1] or None
+			previous_id = position > 0 and ids[position - 1] or None
+			images = Image.objects.in_bulk([image_id for image_id in (next_id, previous_id) if image_id])
+			context['next'] = images.get(next_id)
+			context['previous'] = images.get(previous_id)
+			context.update(self.e_context)
+			return context
+
+		# Seek from the current (order, id) key instead of counting the position
 		base_qs = self.get_queryset()
-		count = base_qs.count()
-		img_pos = base_qs.filter(
+		next = base_qs.filter(
+			Q(order__gt=image.order)|
+			Q(id__gt=image.id, order=image.order)
+		).order_by('order', 'id')[:1]
+		previous = base_qs.filter(
 			Q(order__lt=image.order)|
 			Q(id__lt=image.id, order=image.order)
-		).count()
-		next = None
-		previous = None
-		if count - 1 > img_pos:
-			try:
-				next = base_qs.filter(
-					Q(order__gt=image.order)|
-					Q(id__gt=image.id, order=image.order)
-				)[0]
-			except IndexError:
-				pass
-		if img_pos > 0:
-			try:
-				previous = base_qs.filter(
-					Q(order__lt=image.order)|
-					Q(id__lt=image.id, order=image.order)
-				).order_by('-order', '-id')[0]
-			except IndexError:
-				pass
-		context['next'] = next
-		context['previous'] = previous
+		).order_by('-order', '-id')[:1]
+		context['next'] = next and next[0] or None
+		context['previous'] = previous and previous[0] or None
 		context.update(self.e_context)
 		return context
 
@@ -336,28 +506,17 @@ class DeleteAlbum(DeleteView):
 			
 	def delete(self, request, *args, **kwargs):
 		self.object = self.get_object()
-		user = request.user
-		blog_posts = BlogPost.objects.published(for_user=user).select_related().filter(user=user)
-
-		if blog_posts and blog_posts[0]:
-			blog_post = blog_posts[0]
-			blog_post.num_images = blog_post.num_images - self.object.images.all().count()
-			blog_post.save()
-
-		for image in self.object.images.all():
-			delete(image.image)
-			content_type_id = ContentType.objects.get_for_model(image).pk
-			deleteObject(request, content_type_id, image.pk)
-			
+		blog_post = get_blog_post(self.object.user or request.user)
+		if blog_post:
+			quota.release_images(blog_post, self.object.images.count())
 
-		media_root = getattr(settings, 'MEDIA_ROOT', '/')
-		album_dir = self.object.get_album_path()
-		album_abs_dir = os.path.join(media_root, album_dir)
-		os.rmdir(album_abs_dir)
-		
+		# Images are deleted in bulk with their activity stream actions, instead of
+		# deleteObject per image; the album itself still goes through deleteObject
+		deletion.delete_album_images(self.object)
 		content_type_id = ContentType.objects.get_for_model(self.object).pk
 		deleteObject(request, content_type_id, self.object.pk)
-		
+		# Files and thumbnails are removed in the background
+		deletion.schedule_sweep()
 		return HttpResponseRedirect(self.get_success_url())
 
 def json_error_response(error_message):
@@ -383,23 +542,22 @@ class CreateImage(CreateView):
 	def form_valid(self, form):
 
 		user = self.request.user
-		blog_posts = BlogPost.objects.published(for_user=user).select_related().filter(user=user)
-		if blog_posts and blog_posts[0]:
-			blog_post = blog_posts[0]
-
-			if blog_post.num_images < getattr(settings, 'MAX_IMAGES_PER_VENDOR', 10):
-				blog_post.num_images += 1
-				blog_post.save()
-				self.object = form.save(commit=False)
-				
-				if self.object.album.images.exists():
-					self.object.order = self.object.album.images.all().aggregate(Max('order'))['order__max'] + 1 #self.object.album.images.all().count()
-				else:
-					self.object.order = 0
-				
-				self.object.user = self.request.user
-				self.object.save()
+		blog_post = get_blog_post(user)
+		if blog_post:
+			if quota.reserve_images(blog_post):
+				try:
+					self.object = form.save(commit=False)
+					self.object.order = ordering.next_order(self.object.album)
+					self.object.user = self.request.user
+					self.object.save()
+				except:
+					quota.release_images(blog_post)
+					raise
 				
+				similar = similarity.find_similar(self.object)
+				if similar:
+					messages.warning(self.request, _('This image looks like %d of the images you uploaded before') % len(similar))
+
 				if self.object.album:
 					self.object.album.save()
 					
@@ -414,6 +572,82 @@ class CreateImage(CreateView):
 			else:    
 				return json_error_response("'%s' has crossed maximum limit of images" % user)
 
+def chunked_upload_response(upload, status=200):
+	return HttpResponse(json.dumps({'upload_id': upload.upload_id, 'offset': upload.offset}),
+						status=status, content_type='application/json')
+
+@login_required
+@permission_required('%s.add_%s' % (image_applabel, image_classname))
+@require_POST
+def startChunkedUpload(request):
+	filename = os.path.basename(request.POST.get('filename', ''))
+	if not filename:
+		return HttpResponse(json.dumps({"errors": {'filename': [unicode(_('This field is required.'))]}}),
+							status=400, content_type='application/json')
+	upload = ChunkedUpload.objects.create(user=request.user, filename=filename[:255])
+	return chunked_upload_response(upload, status=201)
+
+@login_required
+@permission_required('%s.add_%s' % (image_applabel, image_classname))
+@transaction.commit_on_success
+def appendChunkedUpload(request, upload_id):
+	"""
+	GET returns the offset to resume the upload from.
+	POST appends the request body at ``offset`` GET parameter.
+	"""
+	upload = get_object_or_404(ChunkedUpload.objects.select_for_update(), upload_id=upload_id, user=request.user)
+	if request.method == 'GET':
+		return chunked_upload_response(upload)
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['GET', 'POST'])
+	try:
+		offset = int(request.GET.get('offset', upload.offset))
+		length = int(request.META.get('CONTENT_LENGTH') or 0)
+	except ValueError:
+		return HttpResponseBadRequest()
+	if offset != upload.offset:
+		# Chunk was lost or sent twice, client has to resume from our offset
+		return chunked_upload_response(upload, status=409)
+	try:
+		if offset + length > CHUNKED_UPLOAD_MAX_SIZE:
+			raise UploadTooLarge()
+		# The body may come without Content-Length, the limit is checked while it is read
+		upload.append(request, offset, CHUNKED_UPLOAD_MAX_SIZE)
+	except UploadTooLarge:
+		upload.delete()
+		return HttpResponse(json.dumps({"errors": {'image': [unicode(_('File is too large.'))]}}),
+							status=413, content_type='application/json')
+	if offset == 0 and not upload.is_image():
+		upload.delete()
+		return HttpResponse(json.dumps({"errors": {'image': [unicode(_('Upload a valid image.'))]}}),
+							status=400, content_type='application/json')
+	return chunked_upload_response(upload)
+
+class FinishChunkedUpload(CreateImage):
+	"""
+	Creates image from the assembled chunked upload. Takes the same fields
+	as CreateImage, except the image file.
+	"""
+	http_method_names = ['post']
+
+	def post(self, request, *args, **kwargs):
+		self.upload = get_object_or_404(ChunkedUpload, upload_id=self.kwargs['upload_id'], user=request.user)
+		self.upload_file = UploadedFile(open(self.upload.path, 'rb'), self.upload.filename, size=self.upload.offset)
+		try:
+			response = super(FinishChunkedUpload, self).post(request, *args, **kwargs)
+		finally:
+			self.upload_file.close()
+		if getattr(self, 'object', None) is not None and self.object.pk:
+			self.upload.delete()
+		return response
+
+	def get_form_kwargs(self):
+		kwargs = super(FinishChunkedUpload, self).get_form_kwargs()
+		files = kwargs['files'].copy()
+		files['image'] = self.upload_file
+		kwargs['files'] = files
+		return kwargs
+
 def get_edit_image_queryset(self):
 	if self.request.user.has_perm('%s.moderate_%s' % (image_applabel, image_classname)):
 		return Image.objects.all()
@@ -460,48 +694,71 @@ class DeleteImage(DeleteView):
 
 	def delete(self, request, *args, **kwargs):
 		self.object = self.get_object()
-		if self.object.image:
-			delete(self.object.image)
-		
-		content_type_id = ContentType.objects.get_for_model(self.object).pk
-		deleteObject(request, content_type_id, self.object.pk)
-
-		user = request.user
-		blog_posts = BlogPost.objects.published(for_user=user).select_related().filter(user=user)
-		if blog_posts and blog_posts[0]:
-			blog_post = blog_posts[0]
-			blog_post.num_images = blog_post.num_images - 1
-			blog_post.save() 
+		# The row and the files are removed in the background. userProfile's
+		# deleteObject is not called for images: it would delete the row at once.
+		# Its work for images, removing their activity stream actions, is done
+		# by soft_delete_image, and the row is deleted by the sweep.
+		deletion.soft_delete_image(self.object)
+		deletion.schedule_sweep()
+
+		blog_post = get_blog_post(self.object.user or request.user)
+		if blog_post:
+			quota.release_images(blog_post)
 		return HttpResponseRedirect(self.get_success_url())
 
+def can_change_album(user, album):
+	return album.user == user or user.has_perm('%s.moderate_%ss' % (album_applabel, album_classname))
+
+@login_required
+@require_POST
+@transaction.commit_on_success
 def updateAlbumOrder(request, image_id, new_order):
+	image = get_object_or_404(Image.objects.select_related('album'), id=image_id)
+	if not image.album or not can_change_album(request.user, image.album):
+		return HttpResponse(json.dumps({'success':False}), status=403, content_type='application/json')
+	# Send back the changed orders, the album is renumbered when it runs out of free keys
+	orders = ordering.move_image(image.id, int(new_order))
+	return HttpResponse(json.dumps({'success':True, 'orders': orders}), content_type='application/json')
+
+@login_required
+@require_POST
+@transaction.commit_on_success
+def reorderAlbum(request, album_id):
+	"""
+	Takes complete ordering of the album as ``ids`` list of image ids
+	"""
+	album = get_object_or_404(Album, id=album_id)
+	if not can_change_album(request.user, album):
+		return HttpResponse(json.dumps({'success':False}), status=403, content_type='application/json')
 	try:
-		imageObj = Image.objects.get(id=image_id)
-		prev_order = imageObj.order
-		next_order = int(new_order)
-		if next_order != prev_order:
-			if next_order > prev_order:
-				orders = imageObj.album.images.filter(Q(order__gte=prev_order) &  Q(order__lt=next_order)).values_list('order', flat=True)
-
-				image_queryset = imageObj.album.images.filter(Q(order__gt=prev_order) &  Q(order__lte=next_order))
-
-			elif next_order < prev_order:
-				orders = imageObj.album.images.filter(Q(order__lte=prev_order) &  Q(order__gt=next_order)).values_list('order', flat=True)
-
-				image_queryset = imageObj.album.images.filter(Q(order__lt=prev_order) &  Q(order__gte=next_order))
-
-			for image, order in zip(image_queryset, orders):
-				image.order = order
-				image.save()
-
-			imageObj.order = next_order
-			imageObj.save()
-			return HttpResponse(json.dumps({'success':True}))
-		else:
-			return HttpResponse(json.dumps({'success':True}))
-	except:
-		pass
-	return HttpResponse(json.dumps({'success':False}))
+		image_ids = [int(image_id) for image_id in request.POST.getlist('ids')]
+	except ValueError:
+		return HttpResponse(json.dumps({'success':False}), status=400, content_type='application/json')
+	ids = ordering.reorder_album(album, image_ids)
+	return HttpResponse(json.dumps({'success':True, 'ids': ids}), content_type='application/json')
+
+def imageStatus(request, pk):
+	image = get_object_or_404(Image.objects.select_related('album'), pk=pk)
+	if image.album:
+		check_album_access(request, image.album)
+	return HttpResponse(json.dumps({'id': image.id, 'status': image.status}), content_type='application/json')
+
+@login_required
+def similarImages(request, pk):
+	"""
+	Lists images of the owner that look like the image, closest first
+	"""
+	image = get_object_or_404(Image, pk=pk)
+	if image.user != request.user and not request.user.has_perm('%s.moderate_%ss' % (image_applabel, image_classname)):
+		raise PermissionDenied
+	similar = [{
+		'id': other.id,
+		'distance': distance,
+		'title': other.title,
+		'album': other.album_id,
+		'url': other.get_variant_url('thumb'),
+	} for distance, other in similarity.find_similar(image)]
+	return HttpResponse(json.dumps({'id': image.id, 'similar': similar}), content_type='application/json')
 
 def editImage(request, image_id, template='imagestore/forms/edit_image_form.html'):
 	response = None
@@ -5,7 +5,7 @@ setup(
         version = '2.7.3',
         packages = find_packages(),
         install_requires = [
-            'django',
+            'django>=1.4',
             'sorl-thumbnail',
             'south',
             'pil',